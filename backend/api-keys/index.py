@@ -1,17 +1,88 @@
 import json
 import os
+import time
 import secrets
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Создает пул соединений (DB_POOL_MIN..DB_POOL_MAX) при первом обращении
+    Совместим с pgbouncer в transaction mode: соединения не держат
+    сессионного состояния, незавершенная транзакция откатывается при возврате.
+    """
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    """Проверяет соединение; SELECT 1 - только если оно простаивало дольше DB_POOL_HEALTHCHECK_IDLE"""
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+    """Берет проверенное соединение из пула"""
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def release_db_connection(conn) -> None:
+    """Возвращает соединение в пул. Повторный вызов для того же соединения ничего не делает"""
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
 
 def verify_api_key(api_key: str, conn) -> bool:
     """Проверяет валидность API ключа для доступа к управлению ключами"""
@@ -67,6 +138,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -82,7 +154,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn = get_db_connection()
         
         if not verify_api_key(api_key, conn):
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -98,7 +170,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 key_id = body_data.get('key_id')
                 
                 if not key_id:
-                    conn.close()
+                    release_db_connection(conn)
                     return {
                         'statusCode': 400,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -115,7 +187,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 if not existing_key:
                     cur.close()
-                    conn.close()
+                    release_db_connection(conn)
                     return {
                         'statusCode': 404,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -133,7 +205,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 conn.commit()
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 
                 return {
                     'statusCode': 200,
@@ -153,7 +225,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 expiry_days = body_data.get('expiry_days', 'never')
                 
                 if not key_name:
-                    conn.close()
+                    release_db_connection(conn)
                     return {
                         'statusCode': 400,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -175,7 +247,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 key_id = result['id']
                 conn.commit()
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 
                 return {
                     'statusCode': 200,
@@ -196,7 +268,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             key_id = params.get('key_id')
             
             if not key_id:
-                conn.close()
+                release_db_connection(conn)
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -214,7 +286,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             if not existing_key:
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 return {
                     'statusCode': 404,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -228,7 +300,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             
             return {
                 'statusCode': 200,
@@ -250,7 +322,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             keys = cur.fetchall()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             
             result = []
             for key in keys:
@@ -275,7 +347,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         else:
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 405,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -297,3 +369,5 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
         }
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
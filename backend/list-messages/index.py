@@ -1,12 +1,315 @@
+import base64
 import json
 import os
+import time
+from datetime import datetime
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Dict, Any, List, Optional, Tuple
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '30'))
+API_KEY_USAGE_FLUSH_INTERVAL = int(os.environ.get('API_KEY_USAGE_FLUSH_INTERVAL', '60'))
+DETAIL_BATCH_MAX = int(os.environ.get('DETAIL_BATCH_MAX', '500'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+# Ключи, успешно прошедшие проверку: {api_key: время проверки}
+_api_key_cache: Dict[str, float] = {}
+# Отложенная запись last_used_at: {api_key: время использования} и время последней записи
+_api_key_last_used: Dict[str, float] = {}
+_api_key_flushed_at: Dict[str, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Создает пул соединений (DB_POOL_MIN..DB_POOL_MAX) при первом обращении
+    Совместим с pgbouncer в transaction mode: соединения не держат
+    сессионного состояния, незавершенная транзакция откатывается при возврате.
+    """
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    """Проверяет соединение; SELECT 1 - только если оно простаивало дольше DB_POOL_HEALTHCHECK_IDLE"""
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    """Берет проверенное соединение из пула"""
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def release_db_connection(conn) -> None:
+    """Возвращает соединение в пул. Повторный вызов для того же соединения ничего не делает"""
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
+
+def flush_api_key_usage(conn) -> None:
+    """Записывает накопленные last_used_at - не чаще раза в API_KEY_USAGE_FLUSH_INTERVAL на ключ"""
+    now = time.time()
+    due = [
+        (key, used_at) for key, used_at in _api_key_last_used.items()
+        if now - _api_key_flushed_at.get(key, 0) >= API_KEY_USAGE_FLUSH_INTERVAL
+    ]
+    
+    if not due:
+        return
+    
+    cur = conn.cursor()
+    try:
+        execute_values(
+            cur,
+            """UPDATE api_keys AS k SET last_used_at = v.used_at
+            FROM (VALUES %s) AS v(api_key, used_at)
+            WHERE k.api_key = v.api_key
+              AND (k.last_used_at IS NULL OR k.last_used_at < v.used_at)""",
+            due,
+            template="(%s, to_timestamp(%s)::timestamp)"
+        )
+        conn.commit()
+    except psycopg2.Error as e:
+        # Учет использования не должен ломать проверку ключа: значения возвращаются
+        # в _api_key_last_used и уйдут следующим сбросом через API_KEY_USAGE_FLUSH_INTERVAL
+        conn.rollback()
+        print(f"[API_KEY] last_used_at flush failed: {e}")
+        for key, used_at in due:
+            _api_key_last_used[key] = max(used_at, _api_key_last_used.get(key, 0))
+            _api_key_flushed_at[key] = now
+        return
+    finally:
+        cur.close()
+    
+    for key, _ in due:
+        _api_key_flushed_at[key] = now
+        _api_key_last_used.pop(key, None)
+
+def verify_api_key(api_key: str, conn) -> bool:
+    """Проверяет валидность API ключа
+    Успешная проверка кэшируется на API_KEY_CACHE_TTL секунд,
+    last_used_at пишется отложенно через flush_api_key_usage
+    """
+    checked_at = _api_key_cache.get(api_key)
+    
+    if not checked_at or time.time() - checked_at >= API_KEY_CACHE_TTL:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
+            (api_key,)
+        )
+        result = cur.fetchone()
+        cur.close()
+        
+        if not result:
+            _api_key_cache.pop(api_key, None)
+            return False
+        
+        _api_key_cache[api_key] = time.time()
+    
+    _api_key_last_used[api_key] = time.time()
+    flush_api_key_usage(conn)
+    return True
+
+def encode_page_cursor(row: Dict[str, Any], direction: str) -> str:
+    """Непрозрачный курсор страницы: ключ (created_at, id) граничной строки и направление"""
+    raw = json.dumps({'created_at': row['created_at'].isoformat(), 'id': row['id'], 'dir': direction})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_page_cursor(cursor: str) -> Tuple[str, int, str]:
+    """Разбирает курсор страницы, ValueError - если курсор поврежден"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        direction = data['dir']
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return datetime.fromisoformat(data['created_at']).isoformat(), int(data['id']), direction
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def parse_list_filters(query_params: Dict[str, Any]) -> Dict[str, str]:
+    """Фильтры списка из query string, ValueError - если граница диапазона не дата
+    Границы со смещением (+03:00, Z) сравниваются как timestamptz, без смещения -
+    во временной зоне сессии БД, как и NOW(), которым заполняется created_at
+    """
+    filters = {
+        key: query_params[key] for key in ('status', 'provider', 'recipient')
+        if query_params.get(key)
+    }
+    for key in ('created_from', 'created_to'):
+        if query_params.get(key):
+            try:
+                filters[key] = datetime.fromisoformat(query_params[key]).isoformat()
+            except ValueError as e:
+                raise ValueError(f'Invalid {key}') from e
+    return filters
+
+def list_messages(filters: Dict[str, str], limit: int, cursor: Optional[str],
+                  conn) -> Tuple[List[Dict], Optional[str], Optional[str]]:
+    """Страница сообщений от новых к старым (keyset по (created_at, id))
+    Стоимость запроса не зависит от глубины страницы: граница берется из курсора,
+    а не через OFFSET. Фильтры - равенство по status/provider/recipient и диапазон
+    created_at, каждую комбинацию обслуживает индекс с хвостом (created_at, id).
+    Возвращает строки, курсор следующей (более старой) и предыдущей (более новой) страницы.
+    """
+    conditions = []
+    params: List[Any] = []
+    direction = 'next'
+    
+    for key in ('status', 'provider', 'recipient'):
+        if filters.get(key):
+            conditions.append(f"{key} = %s")
+            params.append(filters[key])
+    if filters.get('created_from'):
+        conditions.append("created_at >= %s::timestamptz")
+        params.append(filters['created_from'])
+    if filters.get('created_to'):
+        conditions.append("created_at < %s::timestamptz")
+        params.append(filters['created_to'])
+    
+    if cursor:
+        created_at, last_id, direction = decode_page_cursor(cursor)
+        conditions.append(
+            "(created_at, id) < (%s::timestamp, %s)" if direction == 'next'
+            else "(created_at, id) > (%s::timestamp, %s)"
+        )
+        params.extend([created_at, last_id])
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'DESC' if direction == 'next' else 'ASC'
+    
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT id, message_id, recipient, provider, status, attempts, max_attempts, created_at
+        FROM messages
+        {where}
+        ORDER BY created_at {order}, id {order}
+        LIMIT %s
+        """,
+        params + [limit + 1]
+    )
+    rows = cur.fetchall()
+    cur.close()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+    
+    if not rows:
+        return [], None, None
+    
+    # Для прямого обхода "ещё" означает более старые строки, для обратного - более новые;
+    # с противоположной стороны строки есть всегда, если мы пришли по курсору
+    has_older = has_more if direction == 'next' else True
+    has_newer = bool(cursor) if direction == 'next' else has_more
+    next_cursor = encode_page_cursor(rows[-1], 'next') if has_older else None
+    prev_cursor = encode_page_cursor(rows[0], 'prev') if has_newer else None
+    return rows, next_cursor, prev_cursor
+
+def get_message_details(message_ids: List[str], conn) -> List[Dict]:
+    """Сообщения с историей попыток доставки одним запросом
+    Попытки собираются в JSON-массив на стороне БД (json_agg по индексу
+    delivery_attempts.message_id), порядок сообщений - как в message_ids.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT m.message_id, m.recipient, m.provider, m.message_text, m.status,
+               m.attempts, m.max_attempts, m.created_at,
+               COALESCE(a.delivery_attempts, '[]'::json) AS delivery_attempts
+        FROM messages m
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object(
+                       'id', d.id,
+                       'status', d.status,
+                       'response_code', d.response_code,
+                       'response_body', d.response_body,
+                       'error_message', d.error_message,
+                       'attempted_at', d.attempted_at
+                   ) ORDER BY d.attempted_at) AS delivery_attempts
+            FROM delivery_attempts d
+            WHERE d.message_id = m.message_id
+        ) a ON true
+        WHERE m.message_id = ANY(%s)
+        """,
+        (message_ids,)
+    )
+    rows = {row['message_id']: row for row in cur.fetchall()}
+    cur.close()
+    
+    details = []
+    for message_id in message_ids:
+        row = rows.get(message_id)
+        if not row:
+            continue
+        details.append({
+            'message_id': row['message_id'],
+            'recipient': row['recipient'],
+            'provider': row['provider'],
+            'message_text': row['message_text'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'max_attempts': row['max_attempts'],
+            'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+            'delivery_attempts': row['delivery_attempts']
+        })
+    return details
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Получение списка сообщений из базы данных
+    GET /?limit=&cursor= — страница от новых к старым, курсоры next_cursor/prev_cursor в ответе
+    Фильтры: status, provider, recipient, created_from, created_to (ISO-дата, правая граница не включается)
+    GET /?message_id= — сообщение с попытками доставки, ?message_ids=a,b,c — пакетом до DETAIL_BATCH_MAX
     '''
     method: str = event.get('httpMethod', 'GET')
     
@@ -52,97 +355,117 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     limit = int(query_params.get('limit', 50))
     limit = min(max(limit, 1), 100)
     message_id = query_params.get('message_id')
+    message_ids = list(dict.fromkeys(
+        mid.strip() for mid in (query_params.get('message_ids') or '').split(',') if mid.strip()
+    ))
+    page_cursor = query_params.get('cursor')
     
-    conn = psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
-    cursor = conn.cursor()
-    
-    api_key_escaped = api_key.replace("'", "''")
-    cursor.execute(
-        f"SELECT id FROM api_keys WHERE api_key = '{api_key_escaped}' AND is_active = TRUE"
-    )
-    key_row = cursor.fetchone()
-    
-    if not key_row:
-        cursor.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'success': False, 'error': 'Invalid API key'}),
-            'isBase64Encoded': False
-        }
-    
-    cursor.execute(
-        f"UPDATE api_keys SET last_used_at = NOW() WHERE api_key = '{api_key_escaped}'"
-    )
-    conn.commit()
-    
-    if message_id:
-        message_id_escaped = message_id.replace("'", "''")
-        cursor.execute(
-            f"""
-            SELECT message_id, recipient, provider, message_text, status, attempts, max_attempts, created_at 
-            FROM messages 
-            WHERE message_id = '{message_id_escaped}'
-            """
-        )
-        msg_row = cursor.fetchone()
-        
-        if not msg_row:
-            cursor.close()
-            conn.close()
+    conn = get_db_connection()
+    try:
+        if not verify_api_key(api_key, conn):
+            release_db_connection(conn)
             return {
-                'statusCode': 404,
+                'statusCode': 401,
                 'headers': {
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({'success': False, 'error': 'Message not found'}),
+                'body': json.dumps({'success': False, 'error': 'Invalid API key'}),
                 'isBase64Encoded': False
             }
-        
-        cursor.execute(
-            f"""
-            SELECT id, status, response_code, response_body, error_message, attempted_at 
-            FROM delivery_attempts 
-            WHERE message_id = '{message_id_escaped}'
-            ORDER BY attempted_at
-            """
-        )
-        attempts_rows = cursor.fetchall()
-        
-        delivery_attempts = []
-        for att in attempts_rows:
-            delivery_attempts.append({
-                'id': att['id'],
-                'status': att['status'],
-                'response_code': att['response_code'],
-                'response_body': att['response_body'],
-                'error_message': att['error_message'],
-                'attempted_at': att['attempted_at'].isoformat() if att['attempted_at'] else None
+
+        if message_ids:
+            if len(message_ids) > DETAIL_BATCH_MAX:
+                release_db_connection(conn)
+                return {
+                    'statusCode': 400,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({'success': False, 'error': f'Too many message_ids, max {DETAIL_BATCH_MAX}'}),
+                    'isBase64Encoded': False
+                }
+
+            details = get_message_details(message_ids, conn)
+            found = {detail['message_id'] for detail in details}
+            release_db_connection(conn)
+
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'success': True,
+                    'messages': details,
+                    'count': len(details),
+                    'not_found': [mid for mid in message_ids if mid not in found]
+                }),
+                'isBase64Encoded': False
+            }
+
+        if message_id:
+            details = get_message_details([message_id], conn)
+
+            if not details:
+                release_db_connection(conn)
+                return {
+                    'statusCode': 404,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({'success': False, 'error': 'Message not found'}),
+                    'isBase64Encoded': False
+                }
+
+            release_db_connection(conn)
+
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'success': True,
+                    'message': details[0]
+                }),
+                'isBase64Encoded': False
+            }
+
+        try:
+            filters = parse_list_filters(query_params)
+            rows, next_cursor, prev_cursor = list_messages(filters, limit, page_cursor, conn)
+        except ValueError as e:
+            release_db_connection(conn)
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({'success': False, 'error': str(e)}),
+                'isBase64Encoded': False
+            }
+
+        messages = []
+
+        for row in rows:
+            messages.append({
+                'message_id': row['message_id'],
+                'recipient': row['recipient'],
+                'provider': row['provider'],
+                'status': row['status'],
+                'attempts': row['attempts'],
+                'max_attempts': row['max_attempts'],
+                'created_at': row['created_at'].isoformat() if row['created_at'] else None
             })
-        
-        message_detail = {
-            'message_id': msg_row['message_id'],
-            'recipient': msg_row['recipient'],
-            'provider': msg_row['provider'],
-            'message_text': msg_row['message_text'],
-            'status': msg_row['status'],
-            'attempts': msg_row['attempts'],
-            'max_attempts': msg_row['max_attempts'],
-            'created_at': msg_row['created_at'].isoformat() if msg_row['created_at'] else None,
-            'delivery_attempts': delivery_attempts
-        }
-        
-        cursor.close()
-        conn.close()
-        
+
+        release_db_connection(conn)
+
         return {
             'statusCode': 200,
             'headers': {
@@ -151,47 +474,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             },
             'body': json.dumps({
                 'success': True,
-                'message': message_detail
+                'messages': messages,
+                'count': len(messages),
+                'next_cursor': next_cursor,
+                'prev_cursor': prev_cursor
             }),
             'isBase64Encoded': False
         }
-    
-    cursor.execute(
-        f"""
-        SELECT message_id, recipient, provider, status, attempts, max_attempts, created_at 
-        FROM messages 
-        ORDER BY created_at DESC 
-        LIMIT {limit}
-        """
-    )
-    
-    rows = cursor.fetchall()
-    messages = []
-    
-    for row in rows:
-        messages.append({
-            'message_id': row['message_id'],
-            'recipient': row['recipient'],
-            'provider': row['provider'],
-            'status': row['status'],
-            'attempts': row['attempts'],
-            'max_attempts': row['max_attempts'],
-            'created_at': row['created_at'].isoformat() if row['created_at'] else None
-        })
-    
-    cursor.close()
-    conn.close()
-    
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({
-            'success': True,
-            'messages': messages,
-            'count': len(messages)
-        }),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
@@ -1,19 +1,99 @@
 import json
 import os
+import time
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+PROVIDER_CHANGES_CHANNEL = 'provider_config_changed'
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '30'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+# Ключи, успешно прошедшие проверку: {api_key: время проверки}
+_api_key_cache: Dict[str, float] = {}
+
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Создает пул соединений (DB_POOL_MIN..DB_POOL_MAX) при первом обращении
+    Совместим с pgbouncer в transaction mode: соединения не держат
+    сессионного состояния, незавершенная транзакция откатывается при возврате.
+    """
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    """Проверяет соединение; SELECT 1 - только если оно простаивало дольше DB_POOL_HEALTHCHECK_IDLE"""
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+    """Берет проверенное соединение из пула"""
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def release_db_connection(conn) -> None:
+    """Возвращает соединение в пул. Повторный вызов для того же соединения ничего не делает"""
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
 
 def verify_api_key(api_key: str, conn) -> bool:
-    """Проверяет валидность API ключа"""
+    """Проверяет валидность API ключа (успешная проверка кэшируется на API_KEY_CACHE_TTL секунд)"""
+    checked_at = _api_key_cache.get(api_key)
+    if checked_at and time.time() - checked_at < API_KEY_CACHE_TTL:
+        return True
+    
     cur = conn.cursor()
     cur.execute(
         "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
@@ -21,7 +101,19 @@ def verify_api_key(api_key: str, conn) -> bool:
     )
     result = cur.fetchone()
     cur.close()
-    return result is not None
+    
+    if not result:
+        _api_key_cache.pop(api_key, None)
+        return False
+    
+    _api_key_cache[api_key] = time.time()
+    return True
+
+def notify_provider_changed(provider_code: str, conn) -> None:
+    """Уведомляет кэши провайдеров в других функциях (доставляется при commit)"""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_notify(%s, %s)", (PROVIDER_CHANGES_CHANNEL, provider_code))
+    cur.close()
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -51,6 +143,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -66,7 +159,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn = get_db_connection()
         
         if not verify_api_key(api_key, conn):
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -85,7 +178,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 smsaero_api_key = params.get('smsaero_api_key')
 
                 if not provider_code:
-                    conn.close()
+                    release_db_connection(conn)
                     return {
                         'statusCode': 400,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -107,7 +200,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         smsaero_email = smsaero_email or config.get('smsaero_email')
                         smsaero_api_key = smsaero_api_key or config.get('smsaero_api_key')
 
-                conn.close()
+                release_db_connection(conn)
 
                 if not smsaero_email or not smsaero_api_key:
                     return {
@@ -159,7 +252,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 provider_code = params.get('provider_code')
                 
                 if not provider_code:
-                    conn.close()
+                    release_db_connection(conn)
                     return {
                         'statusCode': 400,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -174,7 +267,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 result = cur.fetchone()
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 
                 if not result:
                     return {
@@ -223,7 +316,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 providers = cur.fetchall()
                 cur.close()
-                conn.close()
+                release_db_connection(conn)
                 
                 result = []
                 for p in providers:
@@ -310,7 +403,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             tg_api_hash = body_data.get('tg_api_hash')
 
             if not provider_code:
-                conn.close()
+                release_db_connection(conn)
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -323,7 +416,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 try:
                     valid = check_tg_credentials(int(tg_api_id), tg_api_hash)
                     if not valid:
-                        conn.close()
+                        release_db_connection(conn)
                         return {
                             'statusCode': 400,
                             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -332,7 +425,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         }
                     print(f"[TG AUTH] API ID/Hash valid for {provider_code}")
                 except Exception as e:
-                    conn.close()
+                    release_db_connection(conn)
                     print(f"[TG AUTH] Error: {e}")
                     return {
                         'statusCode': 400,
@@ -353,7 +446,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 print(f"[SMSAERO AUTH] status={auth_resp.status_code} body={auth_resp.text}")
                 if auth_resp.status_code != 200 or not auth_resp.json().get('success'):
-                    conn.close()
+                    release_db_connection(conn)
                     return {
                         'statusCode': 400,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -398,7 +491,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 config['tg_api_hash'] = tg_api_hash
 
             if not provider_name:
-                conn.close()
+                release_db_connection(conn)
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -416,9 +509,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             
             result = cur.fetchone()
+            if result:
+                notify_provider_changed(provider_code, conn)
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             
             if not result:
                 return {
@@ -464,7 +559,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             tg_api_hash = body_data.get('tg_api_hash')
 
             if not provider_code:
-                conn.close()
+                release_db_connection(conn)
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -519,9 +614,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             
             result = cur.fetchone()
+            if result:
+                notify_provider_changed(provider_code, conn)
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             
             if not result:
                 return {
@@ -549,7 +646,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             provider_code = params.get('provider_code')
             
             if not provider_code:
-                conn.close()
+                release_db_connection(conn)
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -563,9 +660,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 (provider_code,)
             )
             result = cur.fetchone()
+            if result:
+                notify_provider_changed(provider_code, conn)
             conn.commit()
             cur.close()
-            conn.close()
+            release_db_connection(conn)
             
             if not result:
                 return {
@@ -612,4 +711,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
@@ -0,0 +1,1503 @@
+"""
+Адаптеры провайдеров доставки: транспорты, их кэши и реестр PROVIDER_ADAPTERS
+Общий модуль функций send и retry - файл одинаковый в обеих папках
+(функции деплоятся независимо), правки вносить в обе копии.
+"""
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+PROVIDER_CACHE_TTL = int(os.environ.get('PROVIDER_CACHE_TTL', '60'))
+PROVIDER_CHANGES_CHANNEL = 'provider_config_changed'
+PROVIDER_LISTENER_RETRY_DELAY = 30
+APNS_URL = 'https://api.push.apple.com'
+POSTBOX_HOST = 'postbox.cloud.yandex.net'
+POSTBOX_REGION = 'ru-central1'
+POSTBOX_SERVICE = 'ses'
+POSTBOX_SEND_PATH = '/v2/email/outbound-emails'
+POSTBOX_SEND_URL = f'https://{POSTBOX_HOST}{POSTBOX_SEND_PATH}'
+FCM_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+FCM_TOKEN_REFRESH_MARGIN = 300
+APNS_TOKEN_TTL = 50 * 60
+APNS_BATCH_CONCURRENCY = int(os.environ.get('APNS_BATCH_CONCURRENCY', '20'))
+POSTBOX_BULK_CONCURRENCY = int(os.environ.get('POSTBOX_BULK_CONCURRENCY', '8'))
+FCM_URL = 'https://fcm.googleapis.com'
+FCM_BATCH_CONCURRENCY = int(os.environ.get('FCM_BATCH_CONCURRENCY', '50'))
+SMSAERO_BULK_MAX_NUMBERS = 50
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3'))
+TIMEOUT_P99_FACTOR = float(os.environ.get('TIMEOUT_P99_FACTOR', '3'))
+TIMEOUT_FLOOR = float(os.environ.get('TIMEOUT_FLOOR', '2'))
+TIMEOUT_SAMPLE_SIZE = int(os.environ.get('TIMEOUT_SAMPLE_SIZE', '500'))
+TIMEOUT_MIN_SAMPLES = int(os.environ.get('TIMEOUT_MIN_SAMPLES', '50'))
+TIMEOUT_CACHE_TTL = int(os.environ.get('TIMEOUT_CACHE_TTL', '60'))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', '2'))
+RATE_LIMIT_THROTTLE_DELAY = float(os.environ.get('RATE_LIMIT_THROTTLE_DELAY', '10'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_PROBE_TIMEOUT = float(os.environ.get('CIRCUIT_PROBE_TIMEOUT', '60'))
+CIRCUIT_CACHE_TTL = float(os.environ.get('CIRCUIT_CACHE_TTL', '5'))
+# Исходы попытки, при которых запрос не расходует попытку и сообщение откладывается
+DEFERRED_OUTCOMES = ('throttled', 'circuit_open')
+# Код отказа в доставке: провайдер ответил, но сообщение не принял (статус не done,
+# success: false, номер отклонен), либо провайдер не настроен. Это не сбой провайдера -
+# в circuit breaker такие ответы не учитываются, в отличие от 5xx, 429 и ошибок транспорта
+PROVIDER_REJECTED = 422
+
+# Keep-alive HTTP сессии по хосту провайдера: {host: requests.Session}
+_http_sessions: Dict[str, requests.Session] = {}
+
+# Кэш строк providers по provider_code: {provider_code: (время загрузки, строка или None)}
+_provider_cache: Dict[str, Tuple[float, Optional[Dict]]] = {}
+_provider_listener = None
+_provider_listener_retry_at = 0.0
+_provider_listener_lock = threading.Lock()
+
+# APNs: HTTP/2 клиенты {(team_id, bundle_id): httpx.Client} и provider token {(team_id, key_id): (iat, jwt)}
+_apns_clients: Dict[Tuple[str, str], Any] = {}
+_apns_tokens: Dict[Tuple[str, str], Tuple[int, str]] = {}
+_apns_lock = threading.Lock()
+
+# Postbox: производные ключи SigV4 {(access_key, date_stamp): (secret_key, k_signing)}
+_postbox_signing_keys: Dict[Tuple[str, str], Tuple[str, bytes]] = {}
+_postbox_lock = threading.Lock()
+
+# FCM: {(project_id, client_email): (private_key, service_account.Credentials)}
+_fcm_credentials: Dict[Tuple[str, str], Tuple[str, Any]] = {}
+_fcm_key_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_fcm_lock = threading.Lock()
+# FCM: HTTP/2 клиенты {project_id: httpx.Client}
+_fcm_clients: Dict[str, Any] = {}
+
+# Ограничение одновременных отправок в процессе: {provider_code: (лимит, семафор)}
+_provider_slots: Dict[str, Tuple[int, threading.BoundedSemaphore]] = {}
+_provider_slots_lock = threading.Lock()
+
+# Открытые цепи, известные процессу: {provider_code: до какого времени не ходить в БД}
+_circuit_open_until: Dict[str, float] = {}
+# Закрытые цепи: {provider_code: (время проверки, отказов в БД)}, верим CIRCUIT_CACHE_TTL секунд
+_circuit_closed: Dict[str, Tuple[float, int]] = {}
+
+# Таймауты по наблюдаемой задержке: {provider_code: (время расчета, (connect, read))}
+_provider_timeouts: Dict[str, Tuple[float, Tuple[float, float]]] = {}
+
+def get_http_session(url: str) -> requests.Session:
+    """Возвращает keep-alive сессию для хоста провайдера (переживает warm-вызовы)"""
+    host = urlsplit(url).netloc
+    session = _http_sessions.get(host)
+    
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session = _http_sessions.setdefault(host, session)
+    
+    return session
+
+def get_provider_listener():
+    """Возвращает соединение, подписанное (LISTEN) на изменения провайдеров
+    Соединение живет между warm-вызовами. LISTEN не работает через pgbouncer
+    в transaction mode, поэтому можно указать прямой адрес в DATABASE_LISTEN_URL.
+    Если подписаться не удалось - кэш работает только по TTL.
+    """
+    global _provider_listener, _provider_listener_retry_at
+    
+    if _provider_listener is not None and not _provider_listener.closed:
+        return _provider_listener
+    
+    if time.time() < _provider_listener_retry_at:
+        return None
+    
+    try:
+        listener = psycopg2.connect(os.environ.get('DATABASE_LISTEN_URL') or os.environ['DATABASE_URL'])
+        listener.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = listener.cursor()
+        cur.execute(f"LISTEN {PROVIDER_CHANGES_CHANNEL}")
+        cur.close()
+    except psycopg2.Error as e:
+        print(f"[PROVIDER CACHE] LISTEN unavailable, falling back to TTL: {e}")
+        _provider_listener = None
+        _provider_listener_retry_at = time.time() + PROVIDER_LISTENER_RETRY_DELAY
+        return None
+    
+    # Пока подписки не было, уведомления могли быть пропущены
+    _provider_cache.clear()
+    _provider_listener = listener
+    return listener
+
+def drain_provider_notifications() -> None:
+    """Сбрасывает из кэша провайдеров, о смене которых пришло уведомление"""
+    global _provider_listener
+    
+    listener = get_provider_listener()
+    if listener is None:
+        return
+    
+    try:
+        listener.poll()
+    except psycopg2.Error as e:
+        print(f"[PROVIDER CACHE] Listener connection lost: {e}")
+        _provider_cache.clear()
+        _provider_listener = None
+        return
+    
+    while listener.notifies:
+        notify = listener.notifies.pop(0)
+        if notify.payload:
+            _provider_cache.pop(notify.payload, None)
+        else:
+            _provider_cache.clear()
+
+def get_provider(provider: str, conn) -> Optional[Dict]:
+    """Возвращает строку провайдера из кэша процесса или из БД"""
+    with _provider_listener_lock:
+        drain_provider_notifications()
+    
+    cached = _provider_cache.get(provider)
+    if cached and time.time() - cached[0] < PROVIDER_CACHE_TTL:
+        return cached[1]
+    
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT provider_code, provider_name, provider_type, is_active, config
+        FROM providers WHERE provider_code = %s""",
+        (provider,)
+    )
+    result = cur.fetchone()
+    cur.close()
+    
+    _provider_cache[provider] = (time.time(), dict(result) if result else None)
+    return _provider_cache[provider][1]
+
+def get_provider_config(provider: str, conn) -> Optional[Dict]:
+    """Возвращает config провайдера (None, если провайдер не найден или не настроен)"""
+    result = get_provider(provider, conn)
+    
+    if not result or not result['config']:
+        return None
+    
+    return result['config']
+
+def check_provider_active(provider: str, conn) -> Tuple[bool, Optional[str]]:
+    """Проверяет активность провайдера"""
+    result = get_provider(provider, conn)
+    
+    if not result:
+        return False, None
+    
+    return result['is_active'], result['provider_name']
+
+def get_wappi_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Получает Wappi credentials и тип провайдера из конфига"""
+    result = get_provider(provider, conn)
+    
+    if not result or not result['config']:
+        return None, None, None
+    
+    config = result['config']
+    return config.get('wappi_token'), config.get('wappi_profile_id'), result['provider_type']
+
+def send_via_wappi(recipient: str, message: str, provider: str, conn,
+                   timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 10)) -> Tuple[int, str]:
+    """Отправляет сообщение через Wappi API"""
+    try:
+        wappi_token, wappi_profile_id, provider_type = get_wappi_credentials(provider, conn)
+        
+        if not wappi_token or not wappi_profile_id:
+            return PROVIDER_REJECTED, json.dumps({"error": "Wappi credentials not configured"})
+        
+        endpoint_map = {
+            'max': 'https://wappi.pro/maxapi/sync/message/send',
+            'telegram_bot': 'https://wappi.pro/tapi/sync/message/send',
+            'whatsapp_business': 'https://wappi.pro/api/sync/message/send',
+            'wappi': 'https://wappi.pro/api/sync/message/send'
+        }
+        
+        api_url = endpoint_map.get(provider_type, 'https://wappi.pro/api/sync/message/send')
+        
+        recipient_clean = recipient.replace('+', '').replace('-', '').replace(' ', '')
+        
+        request_data = json.dumps({
+            'recipient': recipient_clean,
+            'body': message
+        })
+        
+        print(f"[WAPPI] Sending request:")
+        print(f"[WAPPI] Provider code: {provider}")
+        print(f"[WAPPI] Provider type: {provider_type}")
+        print(f"[WAPPI] URL: {api_url}?profile_id={wappi_profile_id}")
+        print(f"[WAPPI] Headers: Authorization: {wappi_token[:10]}...")
+        print(f"[WAPPI] Data: {request_data}")
+        
+        response = get_http_session(api_url).post(
+            api_url,
+            params={'profile_id': wappi_profile_id},
+            headers={
+                'Authorization': wappi_token
+            },
+            data=request_data,
+            timeout=timeout
+        )
+        
+        print(f"[WAPPI] Response status: {response.status_code}")
+        print(f"[WAPPI] Response body: {response.text}")
+        
+        if response.status_code == 200:
+            try:
+                response_data = response.json()
+                if response_data.get('status') == 'done':
+                    return 200, response.text
+                else:
+                    return PROVIDER_REJECTED, response.text
+            except:
+                return response.status_code, response.text
+        
+        return response.status_code, response.text
+        
+    except requests.exceptions.Timeout:
+        return 500, json.dumps({"error": "Request timeout"})
+    except requests.exceptions.RequestException as e:
+        return 500, json.dumps({"error": str(e)})
+
+def get_postbox_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Получает Yandex Postbox credentials из конфига"""
+    config = get_provider_config(provider, conn)
+    
+    if not config:
+        return None, None, None
+    
+    return config.get('postbox_access_key'), config.get('postbox_secret_key'), config.get('postbox_from_email')
+
+def get_postbox_signing_key(access_key: str, secret_key: str, date_stamp: str) -> bytes:
+    """Возвращает производный ключ SigV4 (k_date -> k_region -> k_service -> k_signing)
+    Ключ меняется раз в сутки, поэтому кэшируется по access key и дате.
+    """
+    with _postbox_lock:
+        cached = _postbox_signing_keys.get((access_key, date_stamp))
+    if cached and cached[0] == secret_key:
+        return cached[1]
+    
+    def sign(key, msg):
+        return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+    
+    k_date = sign(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+    k_region = sign(k_date, POSTBOX_REGION)
+    k_service = sign(k_region, POSTBOX_SERVICE)
+    k_signing = sign(k_service, 'aws4_request')
+    
+    # Потоки dispatch_messages подписывают параллельно: чистка и вставка - под блокировкой
+    with _postbox_lock:
+        # Ключи за прошлые даты больше не понадобятся
+        for key in [key for key in _postbox_signing_keys if key[1] != date_stamp]:
+            _postbox_signing_keys.pop(key, None)
+        
+        _postbox_signing_keys[(access_key, date_stamp)] = (secret_key, k_signing)
+    return k_signing
+
+def sign_postbox_requests(bodies: List[str], access_key: str, secret_key: str,
+                          canonical_uri: str = POSTBOX_SEND_PATH) -> List[Dict[str, str]]:
+    """Подписывает пачку POST запросов к Postbox (AWS Signature V4)
+    Все запросы подписываются одной меткой времени и одним производным ключом,
+    на каждое тело - только хэш и итоговый HMAC. Возвращает заголовки для каждого тела.
+    """
+    content_type = 'application/json'
+    algorithm = 'AWS4-HMAC-SHA256'
+    signed_headers = 'content-type;host;x-amz-date'
+    
+    t = datetime.utcnow()
+    amz_date = t.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = t.strftime('%Y%m%d')
+    
+    credential_scope = f'{date_stamp}/{POSTBOX_REGION}/{POSTBOX_SERVICE}/aws4_request'
+    canonical_headers = f'content-type:{content_type}\nhost:{POSTBOX_HOST}\nx-amz-date:{amz_date}\n'
+    k_signing = get_postbox_signing_key(access_key, secret_key, date_stamp)
+    
+    signed = []
+    for body in bodies:
+        payload_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        canonical_request = f'POST\n{canonical_uri}\n\n{canonical_headers}\n{signed_headers}\n{payload_hash}'
+        string_to_sign = f'{algorithm}\n{amz_date}\n{credential_scope}\n' + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        signature = hmac.new(k_signing, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        
+        signed.append({
+            'Content-Type': content_type,
+            'X-Amz-Date': amz_date,
+            'Authorization': f'{algorithm} Credential={access_key}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}'
+        })
+    
+    return signed
+
+def sign_postbox_request(body: str, access_key: str, secret_key: str,
+                         canonical_uri: str = POSTBOX_SEND_PATH) -> Dict[str, str]:
+    """Подписывает один POST запрос к Postbox, возвращает заголовки"""
+    return sign_postbox_requests([body], access_key, secret_key, canonical_uri)[0]
+
+def build_postbox_body(from_email: str, recipient: str, message: str, subject: str,
+                       template_name: Optional[str] = None, template_data: Optional[Dict] = None) -> str:
+    """Формирует тело SendEmail: по шаблону (Template), если указан template_name, иначе Simple"""
+    if template_name:
+        return json.dumps({
+            "FromEmailAddress": from_email,
+            "Destination": {
+                "ToAddresses": [recipient]
+            },
+            "Content": {
+                "Template": {
+                    "TemplateName": template_name,
+                    "TemplateData": json.dumps(template_data or {})
+                }
+            }
+        })
+    
+    return json.dumps({
+        "FromEmailAddress": from_email,
+        "Destination": {
+            "ToAddresses": [recipient]
+        },
+        "Content": {
+            "Simple": {
+                "Subject": {
+                    "Data": subject,
+                    "Charset": "UTF-8"
+                },
+                "Body": {
+                    "Text": {
+                        "Data": message,
+                        "Charset": "UTF-8"
+                    }
+                }
+            }
+        }
+    })
+
+def send_via_postbox(recipient: str, message: str, subject: Optional[str], provider: str, conn,
+                    template_name: Optional[str] = None, template_data: Optional[Dict] = None,
+                    timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 30)) -> Tuple[int, str]:
+    """Отправляет email через Yandex Postbox API (AWS SES compatible)
+    Поддерживает два режима:
+    - Обычная отправка (SendEmail с Simple) - если template_name не указан
+    - Отправка по шаблону (SendEmail с Template) - если указан template_name
+    """
+    try:
+        access_key, secret_key, from_email = get_postbox_credentials(provider, conn)
+        subject = subject or "Уведомление"
+        
+        if not access_key or not secret_key or not from_email:
+            return PROVIDER_REJECTED, json.dumps({"error": "Postbox credentials not configured"})
+        
+        print(f"[POSTBOX] Using Basic Auth with AWS SigV4")
+        print(f"[POSTBOX] From: {from_email}")
+        print(f"[POSTBOX] To: {recipient}")
+        print(f"[POSTBOX] Subject: {subject}")
+        
+        body = build_postbox_body(from_email, recipient, message, subject, template_name, template_data)
+        
+        headers = sign_postbox_request(body, access_key, secret_key)
+        
+        print(f"[POSTBOX] Request body: {body}")
+        
+        response = get_http_session(POSTBOX_SEND_URL).post(
+            POSTBOX_SEND_URL,
+            headers=headers,
+            data=body,
+            timeout=timeout
+        )
+        
+        print(f"[POSTBOX] Response status: {response.status_code}")
+        print(f"[POSTBOX] Response body: {response.text}")
+        
+        if response.status_code == 200:
+            return 200, response.text
+        else:
+            return response.status_code, response.text
+        
+    except Exception as e:
+        print(f"[POSTBOX ERROR] Unexpected exception:")
+        print(f"[POSTBOX ERROR] Type: {type(e).__name__}")
+        print(f"[POSTBOX ERROR] Message: {str(e)}")
+        import traceback
+        print(f"[POSTBOX ERROR] Traceback: {traceback.format_exc()}")
+        return 500, json.dumps({"error": str(e), "type": type(e).__name__})
+
+def send_via_postbox_bulk(recipients: List[str], message: str, subject: Optional[str], provider: str, conn,
+                         template_name: Optional[str] = None,
+                         template_data: Optional[Dict[str, Optional[Dict]]] = None,
+                         timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 30)) -> Dict[str, Tuple[int, str, int]]:
+    """Отправляет письмо многим получателям, у каждого - свои template_data
+    ({recipient: данные шаблона}). Массовой отправки в Postbox нет, поэтому это отдельные
+    SendEmail: все тела подписываются за один проход одним ключом SigV4 и уходят
+    до POSTBOX_BULK_CONCURRENCY параллельно по keep-alive соединениям - но не больше,
+    чем достается вызову из HTTP_POOL_MAXSIZE при max_concurrency одновременных вызовах.
+    Возвращает {recipient: (status_code, response_body, длительность его запроса в мс)}
+    """
+    access_key, secret_key, from_email = get_postbox_credentials(provider, conn)
+    
+    if not access_key or not secret_key or not from_email:
+        error = (PROVIDER_REJECTED, json.dumps({"error": "Postbox credentials not configured"}), 0)
+        return {recipient: error for recipient in recipients}
+    
+    template_data = template_data or {}
+    bodies = [
+        build_postbox_body(from_email, recipient, message, subject or "Уведомление",
+                           template_name, template_data.get(recipient))
+        for recipient in recipients
+    ]
+    signed_headers = sign_postbox_requests(bodies, access_key, secret_key)
+    session = get_http_session(POSTBOX_SEND_URL)
+    
+    def post(body: str, headers: Dict[str, str]) -> Tuple[int, str, int]:
+        start_time = time.time()
+        try:
+            response = session.post(POSTBOX_SEND_URL, headers=headers, data=body, timeout=timeout)
+            status_code, response_body = response.status_code, response.text
+        except requests.exceptions.RequestException as e:
+            status_code, response_body = 500, json.dumps({"error": str(e), "type": type(e).__name__})
+        return status_code, response_body, int((time.time() - start_time) * 1000)
+    
+    print(f"[POSTBOX] Bulk send to {len(recipients)} recipients, template {template_name}")
+    
+    calls = get_provider_limits(provider, conn)['max_concurrency'] or 1
+    workers = min(POSTBOX_BULK_CONCURRENCY, max(1, HTTP_POOL_MAXSIZE // calls))
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(post, bodies, signed_headers)
+        return dict(zip(recipients, results))
+
+def get_apns_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """Получает APNs credentials из конфига"""
+    config = get_provider_config(provider, conn)
+    
+    if not config:
+        return None, None, None, None
+    
+    return (config.get('apns_team_id'), config.get('apns_key_id'), 
+            config.get('apns_private_key'), config.get('apns_bundle_id'))
+
+def get_apns_token(team_id: str, key_id: str, private_key: str) -> str:
+    """Возвращает provider token (ES256 JWT) для APNs
+    Apple принимает токен до часа и не дает перевыпускать его чаще раза в 20 минут,
+    поэтому подписанный токен переиспользуется APNS_TOKEN_TTL секунд.
+    """
+    import jwt
+    
+    key = (team_id, key_id)
+    
+    with _apns_lock:
+        cached = _apns_tokens.get(key)
+        if cached and time.time() - cached[0] < APNS_TOKEN_TTL:
+            return cached[1]
+        
+        issued_at = int(time.time())
+        token = jwt.encode(
+            {'iss': team_id, 'iat': issued_at},
+            private_key,
+            algorithm='ES256',
+            headers={'alg': 'ES256', 'kid': key_id}
+        )
+        _apns_tokens[key] = (issued_at, token)
+        return token
+
+def get_apns_client(team_id: str, bundle_id: str):
+    """Возвращает HTTP/2 клиент APNs: одно мультиплексированное соединение на команду и bundle"""
+    import httpx
+    
+    key = (team_id, bundle_id)
+    
+    with _apns_lock:
+        client = _apns_clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.Client(
+                http2=True,
+                base_url=APNS_URL,
+                timeout=10,
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1)
+            )
+            _apns_clients[key] = client
+        return client
+
+def build_apns_payload(message: str, title: Optional[str] = None, data: Optional[Dict] = None) -> Dict:
+    """Формирует payload push-уведомления APNs"""
+    payload = {
+        "aps": {
+            "alert": {
+                "body": message
+            },
+            "sound": "default"
+        }
+    }
+    
+    if title:
+        payload["aps"]["alert"]["title"] = title
+    
+    if data:
+        payload.update(data)
+    
+    return payload
+
+def post_apns_push(client, team_id: str, key_id: str, private_key: str, bundle_id: str,
+                   device_token: str, payload: Dict,
+                   timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 10)) -> Tuple[int, str]:
+    """Отправляет один push через общее HTTP/2 соединение"""
+    import httpx
+    
+    response = client.post(
+        f"/3/device/{device_token}",
+        headers={
+            'authorization': f'bearer {get_apns_token(team_id, key_id, private_key)}',
+            'apns-topic': bundle_id,
+            'apns-push-type': 'alert',
+            'apns-priority': '10'
+        },
+        json=payload,
+        timeout=httpx.Timeout(timeout[1], connect=timeout[0])
+    )
+    
+    if response.status_code == 403 and 'ProviderToken' in response.text:
+        # Токен отозван или истек раньше времени - в следующий раз подписываем заново
+        with _apns_lock:
+            _apns_tokens.pop((team_id, key_id), None)
+    
+    if response.status_code == 200:
+        return 200, json.dumps({"success": True, "apns_id": response.headers.get('apns-id')})
+    return response.status_code, response.text
+
+def send_via_apns(recipient: str, message: str, provider: str, conn, 
+                  title: Optional[str] = None, data: Optional[Dict] = None,
+                  timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 10)) -> Tuple[int, str]:
+    """Отправляет push-уведомление через Apple Push Notification service (APNs) по HTTP/2"""
+    try:
+        team_id, key_id, private_key, bundle_id = get_apns_credentials(provider, conn)
+        
+        if not team_id or not key_id or not private_key or not bundle_id:
+            return PROVIDER_REJECTED, json.dumps({"error": "APNs credentials not configured"})
+        
+        print(f"[APNS] Sending push notification")
+        print(f"[APNS] Team ID: {team_id}")
+        print(f"[APNS] Key ID: {key_id}")
+        print(f"[APNS] Bundle ID: {bundle_id}")
+        print(f"[APNS] Device Token: {recipient[:20]}...")
+        
+        payload = build_apns_payload(message, title, data)
+        print(f"[APNS] Payload: {json.dumps(payload)}")
+        
+        client = get_apns_client(team_id, bundle_id)
+        status_code, response_body = post_apns_push(
+            client, team_id, key_id, private_key, bundle_id, recipient, payload, timeout
+        )
+        
+        print(f"[APNS] Response status: {status_code}")
+        print(f"[APNS] Response body: {response_body}")
+        
+        return status_code, response_body
+        
+    except ImportError:
+        return PROVIDER_REJECTED, json.dumps({"error": "PyJWT or httpx[http2] library not installed"})
+    except Exception as e:
+        print(f"[APNS ERROR] {str(e)}")
+        return 500, json.dumps({"error": str(e)})
+
+def send_via_apns_batch(recipients: List[str], message: str, provider: str, conn,
+                        title: Optional[str] = None, data: Optional[Dict] = None,
+                        timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 10)) -> Dict[str, Tuple[int, str, int]]:
+    """Отправляет одно уведомление на много устройств: параллельные потоки поверх
+    одного HTTP/2 соединения и одного provider token
+    Возвращает {device_token: (status_code, response_body, длительность его запроса в мс)}
+    """
+    try:
+        team_id, key_id, private_key, bundle_id = get_apns_credentials(provider, conn)
+        
+        if not team_id or not key_id or not private_key or not bundle_id:
+            error = (PROVIDER_REJECTED, json.dumps({"error": "APNs credentials not configured"}), 0)
+            return {token: error for token in recipients}
+        
+        payload = build_apns_payload(message, title, data)
+        client = get_apns_client(team_id, bundle_id)
+    except ImportError:
+        error = (PROVIDER_REJECTED, json.dumps({"error": "PyJWT or httpx[http2] library not installed"}), 0)
+        return {token: error for token in recipients}
+    
+    def push(device_token: str) -> Tuple[int, str, int]:
+        start_time = time.time()
+        try:
+            status_code, response_body = post_apns_push(client, team_id, key_id, private_key, bundle_id,
+                                                        device_token, payload, timeout)
+        except Exception as e:
+            status_code, response_body = 500, json.dumps({"error": str(e)})
+        return status_code, response_body, int((time.time() - start_time) * 1000)
+    
+    print(f"[APNS] Batch push to {len(recipients)} devices, bundle {bundle_id}")
+    
+    with ThreadPoolExecutor(max_workers=APNS_BATCH_CONCURRENCY) as executor:
+        results = executor.map(push, recipients)
+        return dict(zip(recipients, results))
+
+def get_fcm_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Получает FCM credentials из конфига"""
+    config = get_provider_config(provider, conn)
+    
+    if not config:
+        return None, None, None
+    
+    return (config.get('fcm_project_id'), config.get('fcm_private_key'), 
+            config.get('fcm_client_email'))
+
+def get_fcm_access_token(project_id: str, private_key: str, client_email: str) -> str:
+    """Возвращает OAuth access token FCM из кэша процесса
+    Токен обновляется заранее, за FCM_TOKEN_REFRESH_MARGIN секунд до истечения.
+    Обновление под блокировкой ключа: параллельные запросы ждут один refresh.
+    """
+    from google.oauth2 import service_account
+    from google.auth.transport.requests import Request
+    
+    key = (project_id, client_email)
+    
+    with _fcm_lock:
+        key_lock = _fcm_key_locks.setdefault(key, threading.Lock())
+    
+    with key_lock:
+        cached = _fcm_credentials.get(key)
+        
+        # Ключ в конфиге провайдера сменился - старые credentials не годятся
+        if cached is None or cached[0] != private_key:
+            credentials = service_account.Credentials.from_service_account_info(
+                {
+                    "type": "service_account",
+                    "project_id": project_id,
+                    "private_key": private_key,
+                    "client_email": client_email,
+                    "token_uri": FCM_TOKEN_URI
+                },
+                scopes=['https://www.googleapis.com/auth/firebase.messaging']
+            )
+            _fcm_credentials[key] = (private_key, credentials)
+        else:
+            credentials = cached[1]
+        
+        expires_soon = (
+            not credentials.token or not credentials.expiry or
+            (credentials.expiry - datetime.utcnow()).total_seconds() < FCM_TOKEN_REFRESH_MARGIN
+        )
+        if expires_soon:
+            credentials.refresh(Request(session=get_http_session(FCM_TOKEN_URI)))
+            print(f"[FCM] Access token refreshed for {project_id}, expires at {credentials.expiry}")
+        
+        return credentials.token
+
+def get_fcm_client(project_id: str):
+    """Возвращает HTTP/2 клиент FCM: одно мультиплексированное соединение на проект"""
+    import httpx
+    
+    with _fcm_lock:
+        client = _fcm_clients.get(project_id)
+        if client is None or client.is_closed:
+            client = httpx.Client(
+                http2=True,
+                base_url=FCM_URL,
+                timeout=10,
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1)
+            )
+            _fcm_clients[project_id] = client
+        return client
+
+def build_fcm_payload(device_token: str, message: str, title: Optional[str] = None,
+                      data: Optional[Dict] = None) -> Dict:
+    """Формирует сообщение FCM HTTP v1 для одного устройства"""
+    payload = {
+        "message": {
+            "token": device_token,
+            "notification": {
+                "body": message
+            }
+        }
+    }
+    
+    if title:
+        payload["message"]["notification"]["title"] = title
+    
+    if data:
+        payload["message"]["data"] = {k: str(v) for k, v in data.items()}
+    
+    return payload
+
+def check_fcm_response(status_code: int, response_text: str, project_id: str,
+                       client_email: str) -> Tuple[int, str]:
+    """Разбирает ответ FCM
+    401 - токен доступа отклонен, при следующей отправке будет получен новый.
+    404 UNREGISTERED - приложение удалено или токен устарел, возвращается как 410:
+    повторять такую отправку бессмысленно.
+    """
+    if status_code == 401:
+        _fcm_credentials.pop((project_id, client_email), None)
+    
+    if status_code == 404 and 'UNREGISTERED' in response_text:
+        return 410, response_text
+    
+    return status_code, response_text
+
+def send_via_fcm(recipient: str, message: str, provider: str, conn,
+                 title: Optional[str] = None, data: Optional[Dict] = None,
+                 timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 10)) -> Tuple[int, str]:
+    """Отправляет push-уведомление через Firebase Cloud Messaging (FCM)"""
+    try:
+        project_id, private_key, client_email = get_fcm_credentials(provider, conn)
+        
+        if not project_id or not private_key or not client_email:
+            return PROVIDER_REJECTED, json.dumps({"error": "FCM credentials not configured"})
+        
+        print(f"[FCM] Sending push notification")
+        print(f"[FCM] Project ID: {project_id}")
+        print(f"[FCM] Device Token: {recipient[:20]}...")
+        
+        access_token = get_fcm_access_token(project_id, private_key, client_email)
+        
+        fcm_url = f"{FCM_URL}/v1/projects/{project_id}/messages:send"
+        payload = build_fcm_payload(recipient, message, title, data)
+        
+        print(f"[FCM] URL: {fcm_url}")
+        print(f"[FCM] Payload: {json.dumps(payload)}")
+        
+        response = get_http_session(fcm_url).post(
+            fcm_url,
+            headers={
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            },
+            json=payload,
+            timeout=timeout
+        )
+        
+        print(f"[FCM] Response status: {response.status_code}")
+        print(f"[FCM] Response body: {response.text}")
+        
+        return check_fcm_response(response.status_code, response.text, project_id, client_email)
+        
+    except ImportError:
+        return PROVIDER_REJECTED, json.dumps({"error": "Google libraries not installed"})
+    except Exception as e:
+        print(f"[FCM ERROR] {str(e)}")
+        return 500, json.dumps({"error": str(e)})
+
+def send_via_fcm_batch(recipients: List[str], message: str, provider: str, conn,
+                       title: Optional[str] = None, data: Optional[Dict] = None,
+                       timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 10)) -> Dict[str, Tuple[int, str, int]]:
+    """Отправляет одно уведомление на много устройств: до FCM_BATCH_CONCURRENCY параллельных
+    потоков поверх одного HTTP/2 соединения и одного access token
+    Возвращает {device_token: (status_code, response_body, длительность его запроса в мс)};
+    410 - токен больше не зарегистрирован
+    """
+    try:
+        import httpx
+        
+        project_id, private_key, client_email = get_fcm_credentials(provider, conn)
+        
+        if not project_id or not private_key or not client_email:
+            error = (PROVIDER_REJECTED, json.dumps({"error": "FCM credentials not configured"}), 0)
+            return {token: error for token in recipients}
+        
+        access_token = get_fcm_access_token(project_id, private_key, client_email)
+        client = get_fcm_client(project_id)
+        request_timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+    except ImportError:
+        error = (PROVIDER_REJECTED, json.dumps({"error": "Google libraries or httpx[http2] not installed"}), 0)
+        return {token: error for token in recipients}
+    
+    def push(device_token: str) -> Tuple[int, str, int]:
+        start_time = time.time()
+        try:
+            response = client.post(
+                f"/v1/projects/{project_id}/messages:send",
+                headers={'Authorization': f'Bearer {access_token}'},
+                json=build_fcm_payload(device_token, message, title, data),
+                timeout=request_timeout
+            )
+            status_code, response_body = check_fcm_response(response.status_code, response.text,
+                                                            project_id, client_email)
+        except Exception as e:
+            status_code, response_body = 500, json.dumps({"error": str(e)})
+        return status_code, response_body, int((time.time() - start_time) * 1000)
+    
+    print(f"[FCM] Batch push to {len(recipients)} devices, project {project_id}")
+    
+    with ThreadPoolExecutor(max_workers=FCM_BATCH_CONCURRENCY) as executor:
+        results = executor.map(push, recipients)
+        return dict(zip(recipients, results))
+
+def get_smsaero_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Получает SMS Aero credentials из конфига"""
+    config = get_provider_config(provider, conn)
+    
+    if not config:
+        return None, None, None
+    
+    return config.get('smsaero_email'), config.get('smsaero_api_key'), config.get('smsaero_sign')
+
+
+def send_via_smsaero(recipient: str, message: str, provider: str, conn,
+                     timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 15)) -> Tuple[int, str]:
+    """Отправляет SMS через SMS Aero API"""
+    import base64
+
+    email, api_key, sign = get_smsaero_credentials(provider, conn)
+
+    if not email or not api_key or not sign:
+        return PROVIDER_REJECTED, json.dumps({"error": "SMS Aero credentials not configured"})
+
+    credentials = base64.b64encode(f"{email}:{api_key}".encode()).decode()
+
+    phone = recipient.replace('+', '').replace('-', '').replace(' ', '').replace('(', '').replace(')', '')
+
+    print(f"[SMSAERO] Sending SMS to {phone}")
+
+    api_url = 'https://gate.smsaero.ru/v2/sms/send'
+    response = get_http_session(api_url).post(
+        api_url,
+        headers={
+            'Authorization': f'Basic {credentials}',
+            'Content-Type': 'application/json'
+        },
+        json={
+            'number': phone,
+            'sign': sign,
+            'text': message,
+            'channel': 'DIRECT'
+        },
+        timeout=timeout
+    )
+
+    print(f"[SMSAERO] Response status: {response.status_code}")
+    print(f"[SMSAERO] Response body: {response.text}")
+
+    if response.status_code == 200:
+        data = response.json()
+        if data.get('success'):
+            return 200, response.text
+        else:
+            return PROVIDER_REJECTED, response.text
+    return response.status_code, response.text
+
+
+def send_via_smsaero_bulk(recipients: List[str], message: str, provider: str, conn,
+                          timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT, 15)) -> Dict[str, Tuple[int, str, int]]:
+    """Отправляет одно SMS на много номеров: по SMSAERO_BULK_MAX_NUMBERS номеров (numbers)
+    на запрос к /v2/sms/send. Результат по номеру сопоставляется с получателем.
+    Возвращает {recipient: (status_code, response_body, длительность запроса с его номером в мс)}
+    """
+    import base64
+
+    email, api_key, sign = get_smsaero_credentials(provider, conn)
+
+    if not email or not api_key or not sign:
+        error = (PROVIDER_REJECTED, json.dumps({"error": "SMS Aero credentials not configured"}), 0)
+        return {recipient: error for recipient in recipients}
+
+    credentials = base64.b64encode(f"{email}:{api_key}".encode()).decode()
+    phones = {
+        recipient: recipient.replace('+', '').replace('-', '').replace(' ', '').replace('(', '').replace(')', '')
+        for recipient in recipients
+    }
+    results: Dict[str, Tuple[int, str, int]] = {}
+
+    api_url = 'https://gate.smsaero.ru/v2/sms/send'
+    for offset in range(0, len(recipients), SMSAERO_BULK_MAX_NUMBERS):
+        chunk = recipients[offset:offset + SMSAERO_BULK_MAX_NUMBERS]
+
+        print(f"[SMSAERO] Bulk SMS to {len(chunk)} numbers")
+
+        start_time = time.time()
+        response = get_http_session(api_url).post(
+            api_url,
+            headers={
+                'Authorization': f'Basic {credentials}',
+                'Content-Type': 'application/json'
+            },
+            json={
+                'numbers': [phones[recipient] for recipient in chunk],
+                'sign': sign,
+                'text': message,
+                'channel': 'DIRECT'
+            },
+            timeout=timeout
+        )
+        duration_ms = int((time.time() - start_time) * 1000)
+
+        print(f"[SMSAERO] Response status: {response.status_code}")
+
+        data = response.json() if response.status_code == 200 else {}
+        if not data.get('success'):
+            code = response.status_code if response.status_code != 200 else PROVIDER_REJECTED
+            results.update({recipient: (code, response.text, duration_ms) for recipient in chunk})
+            continue
+
+        # Для нескольких номеров data - список, для одного - объект
+        items = data.get('data') or []
+        if isinstance(items, dict):
+            items = [items]
+        by_phone = {str(item.get('number')): item for item in items}
+
+        for recipient in chunk:
+            item = by_phone.get(phones[recipient])
+            if item is None:
+                results[recipient] = (PROVIDER_REJECTED, json.dumps({"error": "Number not accepted", "number": phones[recipient]}), duration_ms)
+            else:
+                results[recipient] = (200, json.dumps({"success": True, "data": item}), duration_ms)
+
+    return results
+
+
+def simulate_provider_send(provider: str, recipient: str, message: str) -> Tuple[int, str]:
+    """Симулирует отправку через провайдера (заглушка для не интегрированных провайдеров)"""
+    time.sleep(0.1)
+    
+    success_rate = 0.8
+    
+    if random.random() < success_rate:
+        return 200, json.dumps({"success": True, "message_id": str(uuid.uuid4())})
+    else:
+        return 500, json.dumps({"success": False, "error": "Provider temporary unavailable"})
+
+# Реестр адаптеров по provider_type:
+# send - транспорт, вызывается с recipient, message, provider, conn и полями payload из options
+# batch - транспорт одного сообщения на много получателей (None - только поштучно),
+#         вызывается с recipients, message, provider, conn, timeout и options, возвращает
+#         {recipient: (status_code, response_body, длительность запроса в мс)};
+#         batch_size - сколько получателей отдавать ему за раз,
+#         per_recipient - поля payload, которые batch принимает свои для каждого получателя,
+#         requests_per_recipient - batch шлет каждому получателю отдельный запрос:
+#         вызов берет по токену rate limit на получателя
+# max_concurrency - сколько отправок к провайдеру допустимо одновременно
+# timeout - потолок таймаута чтения, он же таймаут, пока нет статистики задержек
+WAPPI_ADAPTER = {
+    'send': send_via_wappi,
+    'options': [],
+    'batch': None,
+    'max_concurrency': 4,
+    'timeout': 10
+}
+
+PROVIDER_ADAPTERS: Dict[str, Dict[str, Any]] = {
+    'whatsapp_business': WAPPI_ADAPTER,
+    'telegram_bot': WAPPI_ADAPTER,
+    'wappi': WAPPI_ADAPTER,
+    'max': WAPPI_ADAPTER,
+    'yandex_postbox': {
+        'send': send_via_postbox,
+        'options': ['subject', 'template_name', 'template_data'],
+        'batch': send_via_postbox_bulk,
+        'batch_size': 100,
+        'per_recipient': ['template_data'],
+        'requests_per_recipient': True,
+        'max_concurrency': 8,
+        'timeout': 30
+    },
+    'fcm': {
+        'send': send_via_fcm,
+        'options': ['title', 'data'],
+        'batch': send_via_fcm_batch,
+        'batch_size': 500,
+        'requests_per_recipient': True,
+        'max_concurrency': 10,
+        'timeout': 10
+    },
+    'apns': {
+        'send': send_via_apns,
+        'options': ['title', 'data'],
+        'batch': send_via_apns_batch,
+        'batch_size': 500,
+        'requests_per_recipient': True,
+        'max_concurrency': APNS_BATCH_CONCURRENCY,
+        'timeout': 10
+    },
+    'sms_aero': {
+        'send': send_via_smsaero,
+        'options': [],
+        'batch': send_via_smsaero_bulk,
+        'batch_size': SMSAERO_BULK_MAX_NUMBERS,
+        'max_concurrency': 4,
+        'timeout': 15
+    }
+}
+
+def get_provider_adapter(provider: str, conn) -> Optional[Dict[str, Any]]:
+    """Возвращает адаптер по provider_type провайдера (None - провайдер не интегрирован)"""
+    result = get_provider(provider, conn)
+    
+    if not result:
+        return None
+    
+    return PROVIDER_ADAPTERS.get(result['provider_type'])
+
+def get_provider_limits(provider: str, conn) -> Dict[str, Any]:
+    """Лимиты провайдера из providers.config:
+    rate_limit_per_sec - скорость пополнения token bucket (не задана - без ограничения),
+    rate_limit_burst - емкость bucket (по умолчанию равна rate_limit_per_sec),
+    max_concurrency - одновременных отправок (по умолчанию - из адаптера)
+    """
+    config = get_provider_config(provider, conn) or {}
+    adapter = get_provider_adapter(provider, conn)
+    rate = float(config.get('rate_limit_per_sec') or 0)
+    max_concurrency = config.get('max_concurrency') or (adapter['max_concurrency'] if adapter else None)
+    
+    return {
+        'rate_per_sec': rate or None,
+        'burst': max(1.0, float(config.get('rate_limit_burst') or rate)),
+        'max_concurrency': int(max_concurrency) if max_concurrency else None
+    }
+
+def reserve_rate_limit(provider: str, limits: Dict[str, Any], conn,
+                       claim: Optional[Tuple[str, tuple]] = None, tokens: int = 1) -> Tuple[bool, float]:
+    """Берет tokens токенов (по одному на запрос к провайдеру) из bucket провайдера
+    в provider_rate_limits. Bucket общий для всех процессов: строка блокируется на время пересчета.
+    Токены можно занять наперед, но не дальше чем на RATE_LIMIT_MAX_WAIT секунд.
+    claim - (sql, параметры) изменяющего запроса, который фиксируется тем же commit
+    (и при лимите - тем же запросом) до обращения к провайдеру: например, вставка
+    сообщения в processing. Выполняется, даже если токена не хватило.
+    Возвращает (True, сколько подождать перед отправкой) или (False, через сколько появится токен)
+    """
+    rate = limits['rate_per_sec']
+    cur = conn.cursor()
+    
+    if not rate:
+        if claim:
+            cur.execute(*claim)
+            conn.commit()
+        cur.close()
+        return True, 0.0
+    
+    row = None
+    
+    for _ in range(2):
+        claim_sql, claim_params = claim or ('SELECT 1', ())
+        cur.execute(
+            f"""WITH claim AS ({claim_sql}), bucket AS (
+                SELECT provider_code,
+                       LEAST(%s, tokens + EXTRACT(EPOCH FROM NOW() - refilled_at) * %s) AS available
+                FROM provider_rate_limits
+                WHERE provider_code = %s
+                FOR UPDATE
+            )
+            UPDATE provider_rate_limits AS l
+            SET tokens = CASE WHEN b.available - %s >= -%s * %s THEN b.available - %s ELSE b.available END,
+                refilled_at = NOW()
+            FROM bucket b
+            WHERE l.provider_code = b.provider_code
+            RETURNING b.available""",
+            tuple(claim_params) + (limits['burst'], rate, provider, tokens, RATE_LIMIT_MAX_WAIT, rate, tokens)
+        )
+        # claim уже выполнен в этой транзакции - при повторе (bucket еще не создан) не нужен
+        claim = None
+        row = cur.fetchone()
+        if row:
+            break
+        cur.execute(
+            """INSERT INTO provider_rate_limits (provider_code, tokens, refilled_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (provider_code) DO NOTHING""",
+            (provider, limits['burst'])
+        )
+    
+    conn.commit()
+    cur.close()
+    
+    wait = max(0.0, (tokens - row['available']) / rate)
+    return wait <= RATE_LIMIT_MAX_WAIT, wait
+
+def get_provider_slots(provider: str, limit: Optional[int]) -> Optional[threading.BoundedSemaphore]:
+    """Семафор одновременных отправок к провайдеру в этом процессе (пересоздается при смене лимита)"""
+    if not limit:
+        return None
+    
+    with _provider_slots_lock:
+        current = _provider_slots.get(provider)
+        if current is None or current[0] != limit:
+            current = (limit, threading.BoundedSemaphore(limit))
+            _provider_slots[provider] = current
+        return current[1]
+
+def get_circuit_policy(provider: str, conn) -> Dict[str, float]:
+    """Параметры circuit breaker из providers.config (circuit_failure_threshold,
+    circuit_open_seconds), по умолчанию - из переменных окружения
+    """
+    config = get_provider_config(provider, conn) or {}
+    return {
+        'failure_threshold': int(config.get('circuit_failure_threshold', CIRCUIT_FAILURE_THRESHOLD)),
+        'open_seconds': float(config.get('circuit_open_seconds', CIRCUIT_OPEN_SECONDS))
+    }
+
+def check_circuit(provider: str, policy: Dict[str, float], conn) -> Tuple[bool, float]:
+    """Проверяет цепь провайдера перед отправкой
+    closed - отправка разрешена. open - отклоняется, пока не пройдет open_seconds;
+    после этого ровно один вызов переводит цепь в half_open и отправляет пробный запрос.
+    Пробу, не вернувшую исход за CIRCUIT_PROBE_TIMEOUT, можно повторить.
+    Закрытое состояние кэшируется в процессе на CIRCUIT_CACHE_TTL секунд - на здоровом
+    провайдере отправка не ходит в provider_circuits; цепь, открытую другим процессом,
+    этот процесс увидит с задержкой до CIRCUIT_CACHE_TTL.
+    Возвращает (можно ли отправлять, через сколько секунд повторить)
+    """
+    now = time.time()
+    open_until = _circuit_open_until.get(provider)
+    if open_until and now < open_until:
+        return False, open_until - now
+    
+    closed = _circuit_closed.get(provider)
+    if closed and now - closed[0] < CIRCUIT_CACHE_TTL:
+        return True, 0.0
+    
+    cur = conn.cursor()
+    cur.execute(
+        """WITH circuit AS (
+            SELECT provider_code, state,
+                   (state = 'open' AND opened_at <= NOW() - make_interval(secs => %s))
+                   OR (state = 'half_open' AND probe_started_at <= NOW() - make_interval(secs => %s)) AS probe,
+                   EXTRACT(EPOCH FROM opened_at + make_interval(secs => %s) - NOW()) AS retry_after
+            FROM provider_circuits
+            WHERE provider_code = %s AND state <> 'closed'
+            FOR UPDATE
+        ), probe AS (
+            UPDATE provider_circuits AS p
+            SET state = 'half_open', probe_started_at = NOW()
+            FROM circuit c
+            WHERE p.provider_code = c.provider_code AND c.probe
+        )
+        SELECT COALESCE(c.state, 'closed') AS state, c.probe, c.retry_after,
+               COALESCE(p.failures, 0) AS failures
+        FROM (SELECT %s::varchar AS provider_code) k
+        LEFT JOIN provider_circuits p ON p.provider_code = k.provider_code
+        LEFT JOIN circuit c ON c.provider_code = k.provider_code""",
+        (policy['open_seconds'], CIRCUIT_PROBE_TIMEOUT, policy['open_seconds'], provider, provider)
+    )
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    
+    if row['state'] == 'closed':
+        _circuit_closed[provider] = (time.time(), row['failures'])
+        return True, 0.0
+    
+    _circuit_closed.pop(provider, None)
+    
+    if row['probe']:
+        print(f"[CIRCUIT] {provider}: half-open, sending probe")
+        return True, 0.0
+    
+    if row['state'] == 'open':
+        retry_after = max(float(row['retry_after'] or 0), 1.0)
+    else:
+        # Пробный запрос уже отправляет другой вызов
+        retry_after = policy['open_seconds']
+    _circuit_open_until[provider] = time.time() + retry_after
+    return False, retry_after
+
+def record_circuit_outcome(provider: str, failed: bool, policy: Dict[str, float], conn) -> None:
+    """Обновляет цепь по исходу отправки
+    Успех закрывает цепь и сбрасывает счетчик. Подряд идущие отказы (5xx, 429, таймауты,
+    ошибки соединения) копятся; на failure_threshold, а также при неудачной пробе
+    в half_open, цепь открывается на open_seconds.
+    provider_circuits пишется только при отказе и смене состояния: успех на закрытой
+    цепи без накопленных отказов (по кэшу check_circuit) ничего не пишет.
+    """
+    if not failed:
+        closed = _circuit_closed.get(provider)
+        if closed and closed[1] == 0:
+            return
+    
+    cur = conn.cursor()
+    
+    if not failed:
+        cur.execute(
+            """UPDATE provider_circuits
+            SET state = 'closed', failures = 0, opened_at = NULL, probe_started_at = NULL
+            WHERE provider_code = %s AND (state <> 'closed' OR failures > 0)
+            RETURNING state""",
+            (provider,)
+        )
+        if cur.fetchone():
+            print(f"[CIRCUIT] {provider}: closed")
+        _circuit_open_until.pop(provider, None)
+        _circuit_closed[provider] = (time.time(), 0)
+    else:
+        cur.execute(
+            """INSERT INTO provider_circuits AS p (provider_code, state, failures, opened_at)
+            VALUES (%s, CASE WHEN %s <= 1 THEN 'open' ELSE 'closed' END, 1,
+                    CASE WHEN %s <= 1 THEN NOW() END)
+            ON CONFLICT (provider_code) DO UPDATE SET
+                failures = p.failures + 1,
+                state = CASE WHEN p.state = 'half_open' OR p.failures + 1 >= %s THEN 'open' ELSE p.state END,
+                opened_at = CASE WHEN p.state = 'half_open' OR (p.state = 'closed' AND p.failures + 1 >= %s)
+                                 THEN NOW() ELSE p.opened_at END
+            RETURNING state, failures""",
+            (provider, policy['failure_threshold'], policy['failure_threshold'],
+             policy['failure_threshold'], policy['failure_threshold'])
+        )
+        row = cur.fetchone()
+        if row['state'] == 'open':
+            _circuit_closed.pop(provider, None)
+            _circuit_open_until[provider] = time.time() + policy['open_seconds']
+            print(f"[CIRCUIT] {provider}: open for {policy['open_seconds']}s")
+        elif row['state'] == 'closed':
+            _circuit_closed[provider] = (time.time(), row['failures'])
+    
+    conn.commit()
+    cur.close()
+
+def get_provider_timeout(provider: str, adapter: Dict[str, Any], conn) -> Tuple[float, float]:
+    """Таймауты (connect, read) для отправки через провайдера
+    Read - p99 задержки последних TIMEOUT_SAMPLE_SIZE успешных попыток × TIMEOUT_P99_FACTOR,
+    в пределах от TIMEOUT_FLOOR до timeout адаптера. Пока успешных попыток меньше
+    TIMEOUT_MIN_SAMPLES - timeout адаптера. Пересчитывается раз в TIMEOUT_CACHE_TTL секунд.
+    """
+    cached = _provider_timeouts.get(provider)
+    if cached and time.time() - cached[0] < TIMEOUT_CACHE_TTL:
+        return cached[1]
+    
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT COUNT(*) AS samples,
+                  percentile_cont(0.99) WITHIN GROUP (ORDER BY duration_ms) AS p99
+        FROM (
+            SELECT duration_ms FROM delivery_attempts
+            WHERE provider = %s AND status = 'success' AND duration_ms IS NOT NULL
+            ORDER BY attempted_at DESC
+            LIMIT %s
+        ) recent""",
+        (provider, TIMEOUT_SAMPLE_SIZE)
+    )
+    row = cur.fetchone()
+    cur.close()
+    
+    ceiling = float(adapter['timeout'])
+    if row['samples'] >= TIMEOUT_MIN_SAMPLES:
+        read_timeout = min(ceiling, max(TIMEOUT_FLOOR, row['p99'] / 1000 * TIMEOUT_P99_FACTOR))
+    else:
+        read_timeout = ceiling
+    
+    timeout = (min(HTTP_CONNECT_TIMEOUT, read_timeout), read_timeout)
+    _provider_timeouts[provider] = (time.time(), timeout)
+    return timeout
+
+def build_outcome(status_code: int, response_body: str, duration_ms: int) -> Dict[str, Any]:
+    """Исход попытки по ответу провайдера"""
+    if status_code == 200:
+        return {'status': 'success', 'response_code': status_code, 'response_body': response_body,
+                'error_message': None, 'duration_ms': duration_ms}
+    
+    if status_code == 429:
+        return {'status': 'throttled', 'response_code': status_code, 'response_body': response_body,
+                'error_message': 'Provider throttled the request', 'duration_ms': duration_ms,
+                'retry_after': RATE_LIMIT_THROTTLE_DELAY}
+    
+    if status_code == PROVIDER_REJECTED:
+        return {'status': 'failed', 'response_code': status_code, 'response_body': response_body,
+                'error_message': 'Provider rejected the message', 'duration_ms': duration_ms}
+    
+    if status_code == 410:
+        # Получатель больше не существует (push-токен отозван) - повторы не нужны
+        return {'status': 'failed', 'response_code': status_code, 'response_body': response_body,
+                'error_message': 'Recipient is no longer registered', 'duration_ms': duration_ms,
+                'permanent': True}
+    
+    return {'status': 'failed', 'response_code': status_code, 'response_body': response_body,
+            'error_message': f"Provider returned status {status_code}", 'duration_ms': duration_ms}
+
+def call_provider(provider: str, recipients: List[str], adapter: Optional[Dict[str, Any]], conn,
+                  send: Callable[[Optional[Tuple[float, float]]], Dict[str, tuple]],
+                  claim: Optional[Tuple[str, tuple]] = None) -> Dict[str, Dict[str, Any]]:
+    """Выполняет один вызов провайдера с учетом его цепи и лимитов
+    send(timeout) отправляет сообщение получателям recipients и возвращает
+    {recipient: (status_code, response_body)} или, если запросов несколько,
+    {recipient: (status_code, response_body, длительность запроса в мс)} - тогда в попытку
+    пишется задержка запроса получателя, а не всего вызова. Вызов занимает один слот
+    конкурентности и один токен rate limit, а если адаптер шлет каждому получателю
+    свой запрос (requests_per_recipient) - по токену на получателя.
+    claim фиксируется вместе с резервированием токена (см. reserve_rate_limit).
+    Возвращает {recipient: исход попытки}, описание исходов - в attempt_delivery.
+    """
+    start_time = time.time()
+    claimed = False
+    
+    def same_for_all(outcome: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        return {recipient: {**outcome, 'claimed': claimed} for recipient in recipients}
+    
+    try:
+        circuit_policy = get_circuit_policy(provider, conn)
+        allowed, retry_after = check_circuit(provider, circuit_policy, conn)
+        
+        if not allowed:
+            return same_for_all({'status': 'circuit_open', 'response_code': None, 'response_body': '',
+                                 'error_message': 'Provider circuit is open', 'duration_ms': 0,
+                                 'retry_after': retry_after})
+        
+        limits = get_provider_limits(provider, conn)
+        timeout = get_provider_timeout(provider, adapter, conn) if adapter else None
+        slots = get_provider_slots(provider, limits['max_concurrency'])
+        
+        if slots and not slots.acquire(timeout=RATE_LIMIT_MAX_WAIT):
+            return same_for_all({'status': 'throttled', 'response_code': None, 'response_body': '',
+                                 'error_message': 'Provider concurrency limit reached', 'duration_ms': 0,
+                                 'retry_after': RATE_LIMIT_THROTTLE_DELAY})
+        
+        try:
+            tokens = len(recipients) if adapter and adapter.get('requests_per_recipient') else 1
+            reserved, wait = reserve_rate_limit(provider, limits, conn, claim, tokens)
+            claimed = claim is not None
+            if not reserved:
+                return same_for_all({'status': 'throttled', 'response_code': None, 'response_body': '',
+                                     'error_message': 'Provider rate limit exceeded', 'duration_ms': 0,
+                                     'retry_after': wait})
+            time.sleep(wait)
+            start_time = time.time()
+            
+            try:
+                responses = send(timeout)
+            except Exception:
+                # Исключение транспорта (таймаут, обрыв соединения) - тоже отказ провайдера
+                record_circuit_outcome(provider, True, circuit_policy, conn)
+                raise
+        finally:
+            if slots:
+                slots.release()
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        for recipient in recipients:
+            responses.setdefault(recipient, (500, json.dumps({"error": "No result for recipient"})))
+        
+        # Провайдер жив, если принял хоть одно сообщение; отказ - если ответы только
+        # 5xx и 429. Отказы в доставке (PROVIDER_REJECTED, прочие 4xx) цепь не меняют
+        codes = [response[0] for response in responses.values()]
+        if any(code == 200 for code in codes):
+            record_circuit_outcome(provider, False, circuit_policy, conn)
+        elif any(code >= 500 or code == 429 for code in codes):
+            record_circuit_outcome(provider, True, circuit_policy, conn)
+        
+        outcomes = {}
+        for recipient in recipients:
+            status_code, response_body, *request_ms = responses[recipient]
+            outcome = build_outcome(status_code, response_body, request_ms[0] if request_ms else duration_ms)
+            outcomes[recipient] = {**outcome, 'claimed': claimed}
+        return outcomes
+            
+    except Exception as e:
+        # Упавший запрос цепи, таймаутов или rate limit оставляет транзакцию прерванной -
+        # без отката исход попытки потом не записать
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        duration_ms = int((time.time() - start_time) * 1000)
+        return same_for_all({'status': 'error', 'response_code': None, 'response_body': '',
+                             'error_message': str(e), 'duration_ms': duration_ms})
+
+def attempt_delivery(provider: str, recipient: str, message_text: str, conn,
+                    template_name: Optional[str] = None, template_data: Optional[Dict] = None,
+                    subject: Optional[str] = None, title: Optional[str] = None,
+                    data: Optional[Dict] = None,
+                    claim: Optional[Tuple[str, tuple]] = None) -> Dict[str, Any]:
+    """Пытается доставить сообщение через адаптер провайдера с учетом его лимитов и цепи
+    Возвращает исход попытки: status (success|failed|error|throttled|circuit_open),
+    response_code, response_body, error_message, duration_ms.
+    throttled - упор в лимит, circuit_open - цепь провайдера открыта: retry_after -
+    через сколько секунд повторить; response_code None означает, что запрос
+    провайдеру не отправлялся. permanent - получателя больше нет, повторять не нужно.
+    claim - запрос, зафиксированный до обращения к провайдеру вместе с резервированием
+    токена; claimed - успел ли он выполниться (до этого шага попытка могла не дойти).
+    """
+    payload = {
+        'template_name': template_name,
+        'template_data': template_data,
+        'subject': subject,
+        'title': title,
+        'data': data
+    }
+    
+    try:
+        adapter = get_provider_adapter(provider, conn)
+    except Exception as e:
+        return {'status': 'error', 'response_code': None, 'response_body': '',
+                'error_message': str(e), 'duration_ms': 0}
+    
+    def send(timeout: Optional[Tuple[float, float]]) -> Dict[str, Tuple[int, str]]:
+        if not adapter:
+            return {recipient: simulate_provider_send(provider, recipient, message_text)}
+        options = {key: payload[key] for key in adapter['options']}
+        return {recipient: adapter['send'](
+            recipient=recipient, message=message_text, provider=provider, conn=conn,
+            timeout=timeout, **options
+        )}
+    
+    return call_provider(provider, [recipient], adapter, conn, send, claim)[recipient]
+
+def attempt_batch_delivery(provider: str, recipients: List[str], message_text: str, conn,
+                           template_name: Optional[str] = None, template_data: Optional[Dict] = None,
+                           subject: Optional[str] = None, title: Optional[str] = None,
+                           data: Optional[Dict] = None,
+                           recipient_options: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, Any]]:
+    """Доставляет одно сообщение многим получателям batch-транспортом адаптера
+    (для адаптеров без batch - поштучно). Получатели не должны повторяться.
+    recipient_options - значения полей payload, свои у каждого получателя:
+    {recipient: {'template_data': {...}}}; учитываются поля из per_recipient адаптера.
+    Возвращает {recipient: исход попытки}, как у attempt_delivery
+    """
+    payload = {
+        'template_name': template_name,
+        'template_data': template_data,
+        'subject': subject,
+        'title': title,
+        'data': data
+    }
+    recipient_options = recipient_options or {}
+    
+    try:
+        adapter = get_provider_adapter(provider, conn)
+    except Exception as e:
+        return {recipient: {'status': 'error', 'response_code': None, 'response_body': '',
+                            'error_message': str(e), 'duration_ms': 0} for recipient in recipients}
+    
+    if not adapter or not adapter['batch']:
+        return {
+            recipient: attempt_delivery(provider, recipient, message_text, conn,
+                                        **{**payload, **recipient_options.get(recipient, {})})
+            for recipient in recipients
+        }
+    
+    def send(chunk: List[str], timeout: Optional[Tuple[float, float]]) -> Dict[str, Tuple[int, str, int]]:
+        options = {key: payload[key] for key in adapter['options']}
+        for key in adapter.get('per_recipient', []):
+            options[key] = {
+                recipient: recipient_options.get(recipient, {}).get(key, payload[key])
+                for recipient in chunk
+            }
+        return adapter['batch'](
+            recipients=chunk, message=message_text, provider=provider, conn=conn,
+            timeout=timeout, **options
+        )
+    
+    # Токенов на вызов не может понадобиться больше, чем вмещает bucket, - иначе он не пройдет никогда
+    batch_size = adapter['batch_size']
+    if adapter.get('requests_per_recipient'):
+        try:
+            limits = get_provider_limits(provider, conn)
+        except Exception as e:
+            return {recipient: {'status': 'error', 'response_code': None, 'response_body': '',
+                                'error_message': str(e), 'duration_ms': 0} for recipient in recipients}
+        if limits['rate_per_sec']:
+            batch_size = min(batch_size, int(limits['burst']))
+    
+    outcomes: Dict[str, Dict[str, Any]] = {}
+    for offset in range(0, len(recipients), batch_size):
+        chunk = recipients[offset:offset + batch_size]
+        outcomes.update(call_provider(provider, chunk, adapter, conn,
+                                      lambda timeout, chunk=chunk: send(chunk, timeout)))
+    return outcomes
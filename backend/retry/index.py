@@ -1,21 +1,107 @@
+import base64
 import json
 import os
 import time
-import uuid
-import requests
-from typing import Dict, Any, Optional, Tuple
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from adapters import DEFERRED_OUTCOMES, attempt_delivery
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '30'))
+# Массовый повтор: размер страницы, параллельность и бюджет времени на вызов
+RETRY_BULK_DEFAULT_LIMIT = int(os.environ.get('RETRY_BULK_DEFAULT_LIMIT', '100'))
+RETRY_BULK_MAX_LIMIT = int(os.environ.get('RETRY_BULK_MAX_LIMIT', '500'))
+RETRY_BULK_CONCURRENCY = int(os.environ.get('RETRY_BULK_CONCURRENCY', '4'))
+RETRY_BULK_TIME_BUDGET = float(os.environ.get('RETRY_BULK_TIME_BUDGET', '20'))
+RETRY_LEASE_SECONDS = int(os.environ.get('RETRY_LEASE_SECONDS', '120'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+# Ключи, успешно прошедшие проверку: {api_key: время проверки}
+_api_key_cache: Dict[str, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Создает пул соединений (DB_POOL_MIN..DB_POOL_MAX) при первом обращении
+    Совместим с pgbouncer в transaction mode: соединения не держат
+    сессионного состояния, незавершенная транзакция откатывается при возврате.
+    """
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    """Проверяет соединение; SELECT 1 - только если оно простаивало дольше DB_POOL_HEALTHCHECK_IDLE"""
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+    """Берет проверенное соединение из пула"""
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def release_db_connection(conn) -> None:
+    """Возвращает соединение в пул. Повторный вызов для того же соединения ничего не делает"""
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
 
 def verify_api_key(api_key: str, conn) -> bool:
-    """Проверяет валидность API ключа"""
+    """Проверяет валидность API ключа (успешная проверка кэшируется на API_KEY_CACHE_TTL секунд)"""
+    checked_at = _api_key_cache.get(api_key)
+    if checked_at and time.time() - checked_at < API_KEY_CACHE_TTL:
+        return True
+    
     cur = conn.cursor()
     cur.execute(
         "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
@@ -23,13 +109,19 @@ def verify_api_key(api_key: str, conn) -> bool:
     )
     result = cur.fetchone()
     cur.close()
-    return result is not None
+    
+    if not result:
+        _api_key_cache.pop(api_key, None)
+        return False
+    
+    _api_key_cache[api_key] = time.time()
+    return True
 
 def get_message(message_id: str, conn) -> Optional[Dict]:
     """Получает сообщение из БД"""
     cur = conn.cursor()
     cur.execute(
-        """SELECT message_id, provider, recipient, message_text, status, attempts
+        """SELECT message_id, provider, recipient, message_text, payload, status, attempts
         FROM messages WHERE message_id = %s""",
         (message_id,)
     )
@@ -37,18 +129,22 @@ def get_message(message_id: str, conn) -> Optional[Dict]:
     cur.close()
     return result
 
-def log_attempt(message_id: str, attempt_number: int, provider: str, 
+def log_attempt(message_id: str, provider: str, 
                status: str, response_code: Optional[int], response_body: str,
                error_message: Optional[str], duration_ms: int, conn) -> None:
-    """Логирует попытку доставки"""
+    """Логирует попытку доставки под следующим номером после уже записанных
+    (номера идут подряд, отдельно от attempts: 429 пишется, но попытку не расходует)
+    """
     cur = conn.cursor()
     cur.execute(
         """INSERT INTO delivery_attempts 
         (message_id, attempt_number, provider, status, response_code, 
          response_body, error_message, duration_ms, attempted_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
-        (message_id, attempt_number, provider, status, response_code, 
-         response_body, error_message, duration_ms)
+        SELECT %s, COALESCE(MAX(attempt_number), 0) + 1, %s, %s, %s, %s, %s, %s, NOW()
+        FROM delivery_attempts
+        WHERE message_id = %s""",
+        (message_id, provider, status, response_code, 
+         response_body, error_message, duration_ms, message_id)
     )
     conn.commit()
     cur.close()
@@ -62,14 +158,15 @@ def update_message_status(message_id: str, status: str, attempts: int,
         cur.execute(
             """UPDATE messages 
             SET status = %s, attempts = %s, last_error = %s, 
-                last_attempt_at = NOW(), completed_at = NOW()
+                last_attempt_at = NOW(), completed_at = NOW(), locked_until = NULL
             WHERE message_id = %s""",
             (status, attempts, last_error, message_id)
         )
     else:
         cur.execute(
             """UPDATE messages 
-            SET status = %s, attempts = %s, last_error = %s, last_attempt_at = NOW()
+            SET status = %s, attempts = %s, last_error = %s, last_attempt_at = NOW(),
+                locked_until = NULL
             WHERE message_id = %s""",
             (status, attempts, last_error, message_id)
         )
@@ -77,64 +174,211 @@ def update_message_status(message_id: str, status: str, attempts: int,
     conn.commit()
     cur.close()
 
-def get_wappi_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str]]:
-    """Получает Wappi credentials из конфига провайдера"""
+def defer_message(message_id: str, retry_delay: float, error: str, conn) -> None:
+    """Передает отложенное сообщение (лимит провайдера, открытая цепь) воркеру функции send:
+    status retrying, попытка через retry_delay секунд, attempts не меняется
+    """
     cur = conn.cursor()
     cur.execute(
-        "SELECT config FROM providers WHERE provider_code = %s",
-        (provider,)
+        """UPDATE messages 
+        SET status = 'retrying', last_error = %s,
+            next_attempt_at = NOW() + make_interval(secs => %s), locked_until = NULL
+        WHERE message_id = %s""",
+        (error, retry_delay, message_id)
     )
-    result = cur.fetchone()
+    conn.commit()
     cur.close()
+
+def retry_message(message: Dict, conn) -> Dict[str, Any]:
+    """Выполняет одну повторную попытку доставки через адаптер провайдера
+    (те же транспорты, пулы соединений и кэши, что у первой попытки в send)
+    и фиксирует ее результат
+    """
+    message_id = message['message_id']
+    attempt_number = message['attempts'] + 1
+    payload = message.get('payload') or {}
+    
+    outcome = attempt_delivery(
+        message['provider'], message['recipient'], message['message_text'], conn,
+        template_name=payload.get('template_name'), template_data=payload.get('template_data'),
+        subject=payload.get('subject'), title=payload.get('title'), data=payload.get('data')
+    )
+    sent = outcome['status'] not in DEFERRED_OUTCOMES or outcome['response_code'] is not None
+    if sent:
+        log_attempt(message_id, message['provider'], outcome['status'],
+                    outcome['response_code'], outcome['response_body'], outcome['error_message'],
+                    outcome['duration_ms'], conn)
+    
+    if outcome['status'] in DEFERRED_OUTCOMES:
+        # Лимит или открытая цепь провайдера попытку не расходуют - повтор выполнит воркер send
+        defer_message(message_id, outcome['retry_after'], outcome['error_message'], conn)
+        return {'message_id': message_id, 'status': 'retrying', 'attempts': message['attempts'],
+                'error': outcome['error_message']}
     
-    if not result or not result['config']:
-        return None, None
+    if outcome['status'] == 'success':
+        update_message_status(message_id, 'delivered', attempt_number, None, conn)
+        return {'message_id': message_id, 'status': 'delivered', 'attempts': attempt_number, 'error': None}
     
-    config = result['config']
-    return config.get('wappi_token'), config.get('wappi_profile_id')
+    update_message_status(message_id, 'failed', attempt_number, outcome['error_message'], conn)
+    return {'message_id': message_id, 'status': 'failed', 'attempts': attempt_number,
+            'error': outcome['error_message']}
 
-def send_via_wappi(recipient: str, message: str, provider: str, conn) -> Tuple[int, str]:
-    """Отправляет сообщение через Wappi API"""
+def encode_bulk_cursor(last_id: int, started_at: str) -> str:
+    """Непрозрачный курсор массового повтора: последний обработанный id и начало прогона"""
+    raw = json.dumps({'id': last_id, 'started_at': started_at})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_bulk_cursor(cursor: str) -> Tuple[int, str]:
+    """Разбирает курсор массового повтора, ValueError - если курсор поврежден"""
     try:
-        wappi_token, wappi_profile_id = get_wappi_credentials(provider, conn)
-        
-        if not wappi_token or not wappi_profile_id:
-            return 500, json.dumps({"error": "Wappi credentials not configured"})
-        
-        recipient_clean = recipient.replace('+', '').replace('-', '').replace(' ', '')
-        
-        response = requests.post(
-            'https://wappi.pro/api/sync/message/send',
-            params={'profile_id': wappi_profile_id},
-            headers={
-                'Authorization': wappi_token,
-                'Content-Type': 'application/json'
-            },
-            json={
-                'recipient': recipient_clean,
-                'body': message
-            },
-            timeout=10
-        )
-        
-        return response.status_code, response.text
-        
-    except requests.exceptions.Timeout:
-        return 500, json.dumps({"error": "Request timeout"})
-    except requests.exceptions.RequestException as e:
-        return 500, json.dumps({"error": str(e)})
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return int(data['id']), str(data['started_at'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
 
-def simulate_provider_send(provider: str, recipient: str, message: str) -> Tuple[int, str]:
-    """Симулирует отправку через провайдера"""
-    time.sleep(0.1)
+def parse_bulk_filter(raw: Any) -> Dict[str, Any]:
+    """Проверяет фильтр массового повтора, ValueError - если он пустой или некорректный
+    Границы created_from/created_to приводятся к ISO-формату (со смещением, если оно указано)
+    """
+    if not isinstance(raw, dict):
+        raise ValueError('Invalid filter')
+    if not isinstance(raw.get('message_ids', []), list):
+        raise ValueError('Invalid message_ids')
     
-    import random
-    success_rate = 0.8
+    filters: Dict[str, Any] = {
+        key: str(raw[key]) for key in ('provider', 'error_pattern') if raw.get(key)
+    }
+    for key in ('created_from', 'created_to'):
+        if raw.get(key):
+            try:
+                filters[key] = datetime.fromisoformat(str(raw[key])).isoformat()
+            except ValueError as e:
+                raise ValueError(f'Invalid {key}') from e
+    if raw.get('message_ids'):
+        filters['message_ids'] = [str(message_id) for message_id in raw['message_ids']]
     
-    if random.random() < success_rate:
-        return 200, json.dumps({"success": True, "message_id": str(uuid.uuid4())})
+    if not filters:
+        raise ValueError('Empty filter')
+    return filters
+
+def find_failed_messages(filters: Dict[str, Any], after_id: int, started_at: str,
+                         limit: int, conn) -> List[Dict]:
+    """Выбирает failed сообщения по фильтру постранично (keyset по messages.id)
+    Сообщения, которые уже повторялись в этом прогоне (last_attempt_at после его
+    начала), пропускаются - повторный вызов с тем же курсором после обрыва
+    не отправляет их второй раз.
+    """
+    conditions = [
+        "status = 'failed'",
+        "id > %s",
+        "(last_attempt_at IS NULL OR last_attempt_at < %s)"
+    ]
+    values: List[Any] = [after_id, started_at]
+    
+    if filters.get('provider'):
+        conditions.append("provider = %s")
+        values.append(filters['provider'])
+    if filters.get('created_from'):
+        conditions.append("created_at >= %s::timestamptz")
+        values.append(filters['created_from'])
+    if filters.get('created_to'):
+        conditions.append("created_at < %s::timestamptz")
+        values.append(filters['created_to'])
+    if filters.get('error_pattern'):
+        conditions.append("last_error ILIKE %s")
+        values.append(f"%{filters['error_pattern']}%")
+    if filters.get('message_ids'):
+        conditions.append("message_id = ANY(%s)")
+        values.append(list(filters['message_ids']))
+    
+    values.append(limit)
+    cur = conn.cursor()
+    cur.execute(
+        f"""SELECT id, message_id FROM messages
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id
+        LIMIT %s""",
+        tuple(values)
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+def claim_failed_message(message_id: str, conn) -> Optional[Dict]:
+    """Переводит failed сообщение в processing под аренду
+    Если сообщение уже забрал параллельный прогон или оно перестало быть
+    failed, возвращает None. При падении прогона аренда истекает, и воркер
+    функции send возвращает сообщение в очередь.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """UPDATE messages
+        SET status = 'processing', locked_until = NOW() + make_interval(secs => %s)
+        WHERE message_id = %s AND status = 'failed'
+        RETURNING message_id, provider, recipient, message_text, payload, status, attempts""",
+        (RETRY_LEASE_SECONDS, message_id)
+    )
+    result = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return result
+
+def retry_bulk_item(message_id: str) -> Dict[str, Any]:
+    """Повторяет одно сообщение массового прогона на собственном соединении из пула"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        message = claim_failed_message(message_id, conn)
+        if not message:
+            return {'message_id': message_id, 'status': 'skipped', 'attempts': None, 'error': None}
+        return retry_message(message, conn)
+    except Exception as e:
+        return {'message_id': message_id, 'status': 'error', 'attempts': None, 'error': str(e)}
+    finally:
+        release_db_connection(conn)
+
+def retry_bulk(filters: Dict[str, Any], cursor: Optional[str], limit: int,
+               concurrency: int, conn) -> Dict[str, Any]:
+    """Повторяет страницу failed сообщений с ограниченной параллельностью
+    Сообщения обрабатываются группами по concurrency; после каждой группы
+    проверяется бюджет времени вызова. next_cursor указывает на последнюю
+    полностью обработанную группу - с него прогон продолжается следующим вызовом.
+    """
+    if cursor:
+        after_id, started_at = decode_bulk_cursor(cursor)
     else:
-        return 500, json.dumps({"success": False, "error": "Provider temporary unavailable"})
+        # Время начала прогона берется у БД - в той же шкале, что и last_attempt_at
+        cur = conn.cursor()
+        cur.execute("SELECT LOCALTIMESTAMP AS started_at")
+        after_id, started_at = 0, cur.fetchone()['started_at'].isoformat()
+        cur.close()
+    
+    candidates = find_failed_messages(filters, after_id, started_at, limit, conn)
+    deadline = time.time() + RETRY_BULK_TIME_BUDGET
+    results: List[Dict[str, Any]] = []
+    last_id = after_id
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset in range(0, len(candidates), concurrency):
+            if time.time() >= deadline:
+                break
+            chunk = candidates[offset:offset + concurrency]
+            results.extend(executor.map(retry_bulk_item, [row['message_id'] for row in chunk]))
+            last_id = chunk[-1]['id']
+            print(f"[RETRY BULK] {len(results)}/{len(candidates)} processed, cursor id={last_id}")
+    
+    counts = {status: 0 for status in ['delivered', 'retrying', 'failed', 'skipped', 'error']}
+    for result in results:
+        counts[result['status']] += 1
+    
+    has_more = len(results) < len(candidates) or len(candidates) == limit
+    return {
+        'processed': len(results),
+        **counts,
+        'results': results,
+        'has_more': has_more,
+        'next_cursor': encode_bulk_cursor(last_id, started_at) if has_more else None
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -143,6 +387,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     POST /api/retry
     Body: {"message_id": "msg_abc123"}
     Headers: X-Api-Key
+    409 - сообщение не в статусе failed (его доставляет воркер send)
+    
+    Массовый повтор (постранично, продолжение по next_cursor):
+    Body: {"filter": {"provider", "created_from", "created_to", "error_pattern",
+           "message_ids"}, "limit": 100, "concurrency": 4, "cursor": "..."}
     """
     method = event.get('httpMethod', 'GET')
     
@@ -167,6 +416,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -182,7 +432,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn = get_db_connection()
         
         if not verify_api_key(api_key, conn):
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -191,10 +441,44 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         body_data = json.loads(event.get('body', '{}'))
+        
+        if 'filter' in body_data:
+            try:
+                filters = parse_bulk_filter(body_data.get('filter') or {})
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': str(e)}),
+                    'isBase64Encoded': False
+                }
+            
+            limit = max(1, min(int(body_data.get('limit', RETRY_BULK_DEFAULT_LIMIT)), RETRY_BULK_MAX_LIMIT))
+            # Одно соединение занято вызовом, остальные - под параллельные повторы
+            concurrency = max(1, min(int(body_data.get('concurrency', RETRY_BULK_CONCURRENCY)),
+                                     DB_POOL_MAX - 1))
+            
+            try:
+                summary = retry_bulk(filters, body_data.get('cursor'), limit, concurrency, conn)
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': str(e)}),
+                    'isBase64Encoded': False
+                }
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, **summary}),
+                'isBase64Encoded': False
+            }
+        
         message_id = body_data.get('message_id')
         
         if not message_id:
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -205,7 +489,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         message = get_message(message_id, conn)
         
         if not message:
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -214,7 +498,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         if message['status'] == 'delivered':
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -225,82 +509,67 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        attempt_number = message['attempts'] + 1
-        start_time = time.time()
+        # Повторять вручную можно только failed: queued, processing и retrying
+        # принадлежат воркеру send, параллельная попытка дала бы двойную доставку
+        claimed = claim_failed_message(message_id, conn)
         
-        try:
-            if message['provider'] in ['whatsapp_business', 'telegram_bot', 'wappi']:
-                status_code, response_body = send_via_wappi(
-                    message['recipient'], 
-                    message['message_text'],
-                    message['provider'],
-                    conn
-                )
-            else:
-                status_code, response_body = simulate_provider_send(
-                    message['provider'], 
-                    message['recipient'], 
-                    message['message_text']
-                )
-            duration_ms = int((time.time() - start_time) * 1000)
-            
-            if status_code == 200:
-                log_attempt(message_id, attempt_number, message['provider'], 
-                           'success', status_code, response_body, None, duration_ms, conn)
-                update_message_status(message_id, 'delivered', attempt_number, None, conn)
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'message_id': message_id,
-                        'status': 'delivered',
-                        'attempts': attempt_number
-                    }),
-                    'isBase64Encoded': False
-                }
-            else:
-                error_msg = f"Provider returned status {status_code}"
-                log_attempt(message_id, attempt_number, message['provider'], 
-                           'failed', status_code, response_body, error_msg, duration_ms, conn)
-                update_message_status(message_id, 'failed', attempt_number, error_msg, conn)
-                conn.close()
-                
-                return {
-                    'statusCode': 500,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': False,
-                        'message_id': message_id,
-                        'status': 'failed',
-                        'attempts': attempt_number,
-                        'error': error_msg
-                    }),
-                    'isBase64Encoded': False
-                }
-                
-        except Exception as e:
-            duration_ms = int((time.time() - start_time) * 1000)
-            error_msg = str(e)
-            log_attempt(message_id, attempt_number, message['provider'], 
-                       'error', None, '', error_msg, duration_ms, conn)
-            update_message_status(message_id, 'failed', attempt_number, error_msg, conn)
-            conn.close()
-            
+        if not claimed:
+            release_db_connection(conn)
+            return {
+                'statusCode': 409,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'Message is not in failed status',
+                    'message_id': message_id,
+                    'status': message['status']
+                }),
+                'isBase64Encoded': False
+            }
+        
+        result = retry_message(claimed, conn)
+        release_db_connection(conn)
+        
+        if result['status'] == 'delivered':
             return {
-                'statusCode': 500,
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message_id': message_id,
+                    'status': 'delivered',
+                    'attempts': result['attempts']
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if result['status'] == 'retrying':
+            return {
+                'statusCode': 202,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
                     'success': False,
                     'message_id': message_id,
-                    'status': 'failed',
-                    'error': error_msg
+                    'status': 'retrying',
+                    'attempts': result['attempts'],
+                    'error': result['error'],
+                    'message': 'Provider is throttled or unavailable, retry is scheduled.'
                 }),
                 'isBase64Encoded': False
             }
         
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'success': False,
+                'message_id': message_id,
+                'status': 'failed',
+                'attempts': result['attempts'],
+                'error': result['error']
+            }),
+            'isBase64Encoded': False
+        }
+        
     except json.JSONDecodeError:
         return {
             'statusCode': 400,
@@ -314,4 +583,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
@@ -1,640 +1,808 @@
 import json
 import os
+import random
+import threading
 import time
 import uuid
-import requests
-from datetime import datetime
-from typing import Dict, Any, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from adapters import (
+    DEFERRED_OUTCOMES, attempt_batch_delivery, attempt_delivery, check_provider_active,
+    get_provider_adapter, get_provider_config, get_provider_limits
+)
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+# Не меньше двух: пачку доставляют потоки со своими соединениями, пока вызывающий держит свое
+DB_POOL_MAX = max(2, int(os.environ.get('DB_POOL_MAX', '5')))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '30'))
+API_KEY_USAGE_FLUSH_INTERVAL = int(os.environ.get('API_KEY_USAGE_FLUSH_INTERVAL', '60'))
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '1000'))
+BATCH_PROVIDER_CONCURRENCY = int(os.environ.get('BATCH_PROVIDER_CONCURRENCY', '4'))
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '30'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '3600'))
+WORKER_BATCH_SIZE = int(os.environ.get('WORKER_BATCH_SIZE', '20'))
+WORKER_LEASE_SECONDS = int(os.environ.get('WORKER_LEASE_SECONDS', '300'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+# Ключи, успешно прошедшие проверку: {api_key: время проверки}
+_api_key_cache: Dict[str, float] = {}
+# Отложенная запись last_used_at: {api_key: время использования} и время последней записи
+_api_key_last_used: Dict[str, float] = {}
+_api_key_flushed_at: Dict[str, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Создает пул соединений (DB_POOL_MIN..DB_POOL_MAX) при первом обращении
+    Совместим с pgbouncer в transaction mode: соединения не держат
+    сессионного состояния, незавершенная транзакция откатывается при возврате.
+    """
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    """Проверяет соединение; SELECT 1 - только если оно простаивало дольше DB_POOL_HEALTHCHECK_IDLE"""
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+    """Берет проверенное соединение из пула"""
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
 
-def verify_api_key(api_key: str, conn) -> bool:
-    """Проверяет валидность API ключа"""
+def release_db_connection(conn) -> None:
+    """Возвращает соединение в пул. Повторный вызов для того же соединения ничего не делает"""
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
+
+def flush_api_key_usage(conn) -> None:
+    """Записывает накопленные last_used_at - не чаще раза в API_KEY_USAGE_FLUSH_INTERVAL на ключ"""
+    now = time.time()
+    due = [
+        (key, used_at) for key, used_at in _api_key_last_used.items()
+        if now - _api_key_flushed_at.get(key, 0) >= API_KEY_USAGE_FLUSH_INTERVAL
+    ]
+    
+    if not due:
+        return
+    
     cur = conn.cursor()
-    cur.execute(
-        "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
-        (api_key,)
-    )
-    result = cur.fetchone()
+    try:
+        execute_values(
+            cur,
+            """UPDATE api_keys AS k SET last_used_at = v.used_at
+            FROM (VALUES %s) AS v(api_key, used_at)
+            WHERE k.api_key = v.api_key
+              AND (k.last_used_at IS NULL OR k.last_used_at < v.used_at)""",
+            due,
+            template="(%s, to_timestamp(%s)::timestamp)"
+        )
+        conn.commit()
+    except psycopg2.Error as e:
+        # Учет использования не должен ломать проверку ключа: значения возвращаются
+        # в _api_key_last_used и уйдут следующим сбросом через API_KEY_USAGE_FLUSH_INTERVAL
+        conn.rollback()
+        print(f"[API_KEY] last_used_at flush failed: {e}")
+        for key, used_at in due:
+            _api_key_last_used[key] = max(used_at, _api_key_last_used.get(key, 0))
+            _api_key_flushed_at[key] = now
+        return
+    finally:
+        cur.close()
+    
+    for key, _ in due:
+        _api_key_flushed_at[key] = now
+        _api_key_last_used.pop(key, None)
+
+def verify_api_key(api_key: str, conn) -> bool:
+    """Проверяет валидность API ключа
+    Успешная проверка кэшируется на API_KEY_CACHE_TTL секунд,
+    last_used_at пишется отложенно через flush_api_key_usage
+    """
+    checked_at = _api_key_cache.get(api_key)
     
-    if result:
+    if not checked_at or time.time() - checked_at >= API_KEY_CACHE_TTL:
+        cur = conn.cursor()
         cur.execute(
-            "UPDATE api_keys SET last_used_at = NOW() WHERE api_key = %s",
+            "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
             (api_key,)
         )
-        conn.commit()
+        result = cur.fetchone()
+        cur.close()
+        
+        if not result:
+            _api_key_cache.pop(api_key, None)
+            return False
+        
+        _api_key_cache[api_key] = time.time()
     
-    cur.close()
-    return result is not None
+    _api_key_last_used[api_key] = time.time()
+    flush_api_key_usage(conn)
+    return True
 
-def check_provider_active(provider: str, conn) -> Tuple[bool, Optional[str]]:
-    """Проверяет активность провайдера"""
+def save_message(message_id: str, provider: str, recipient: str, 
+                message_text: str, metadata: Dict, conn,
+                status: str = 'pending', payload: Optional[Dict] = None,
+                max_attempts: int = RETRY_MAX_ATTEMPTS) -> None:
+    """Сохраняет сообщение в БД
+    payload - параметры доставки (subject, template_name, title, data...),
+    нужны воркеру для сообщений в статусе queued
+    """
     cur = conn.cursor()
     cur.execute(
-        "SELECT is_active, provider_name FROM providers WHERE provider_code = %s",
-        (provider,)
+        """INSERT INTO messages 
+        (message_id, provider, recipient, message_text, metadata, payload, status, attempts,
+         max_attempts, created_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
+        (message_id, provider, recipient, message_text, json.dumps(metadata),
+         json.dumps(payload or {}), status, 0, max_attempts)
     )
-    result = cur.fetchone()
+    conn.commit()
     cur.close()
-    
-    if not result:
-        return False, None
-    
-    return result['is_active'], result['provider_name']
 
-def save_message(message_id: str, provider: str, recipient: str, 
-                message_text: str, metadata: Dict, conn) -> None:
-    """Сохраняет сообщение в БД"""
+def save_messages(messages: List[Dict], status: str, conn,
+                  lease_seconds: Optional[int] = None, lease_token: Optional[str] = None) -> None:
+    """Сохраняет пачку сообщений одним multi-row INSERT и одним commit
+    lease_seconds - аренда (locked_until) для сообщений, которые этот вызов доставляет сам
+    (status processing): если он оборвется, release_expired_leases вернет их в очередь.
+    lease_token - токен аренды, с которым потом пишется исход попыток
+    """
     cur = conn.cursor()
-    cur.execute(
+    execute_values(
+        cur,
         """INSERT INTO messages 
-        (message_id, provider, recipient, message_text, metadata, status, attempts, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""",
-        (message_id, provider, recipient, message_text, json.dumps(metadata), 'pending', 0)
+        (message_id, provider, recipient, message_text, metadata, payload, status, attempts,
+         max_attempts, locked_until, lease_token, created_at)
+        VALUES %s""",
+        [
+            (m['message_id'], m['provider'], m['recipient'], m['message_text'],
+             json.dumps(m['metadata']), json.dumps(m['payload']), status, 0, m['max_attempts'],
+             lease_seconds, lease_token)
+            for m in messages
+        ],
+        template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW() + make_interval(secs => %s), %s, NOW())",
+        page_size=1000
     )
     conn.commit()
     cur.close()
 
-def log_attempt(message_id: str, attempt_number: int, provider: str, 
-               status: str, response_code: Optional[int], response_body: str,
-               error_message: Optional[str], duration_ms: int, conn) -> None:
-    """Логирует попытку доставки"""
+def release_expired_leases(conn) -> int:
+    """Возвращает в очередь сообщения, чей воркер не уложился в аренду (упал или завис)"""
     cur = conn.cursor()
     cur.execute(
-        """INSERT INTO delivery_attempts 
-        (message_id, attempt_number, provider, status, response_code, 
-         response_body, error_message, duration_ms, attempted_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
-        (message_id, attempt_number, provider, status, response_code, 
-         response_body, error_message, duration_ms)
+        """UPDATE messages SET status = 'queued', locked_until = NULL, lease_token = NULL
+        WHERE status = 'processing' AND locked_until < NOW()"""
     )
+    released = cur.rowcount
     conn.commit()
     cur.close()
+    return released
 
-def update_message_status(message_id: str, status: str, attempts: int,
-                         last_error: Optional[str], conn) -> None:
-    """Обновляет статус сообщения"""
+def claim_messages(limit: int, conn) -> List[Dict]:
+    """Забирает пачку сообщений к доставке и переводит их в processing
+    Сначала новые из очереди (queued), затем повторы, у которых наступил
+    next_attempt_at (retrying) - каждый выбор идет по своему частичному индексу.
+    FOR UPDATE SKIP LOCKED: параллельные воркеры (процессы, узлы) получают
+    непересекающиеся пачки. Аренда на WORKER_LEASE_SECONDS защищает от потери
+    сообщений при падении воркера, lease_token - от записи исхода воркером,
+    чья аренда уже истекла.
+    """
+    claimed: List[Dict] = []
+    lease_token = uuid.uuid4().hex
+    leased_at = time.time()
     cur = conn.cursor()
     
-    if status == 'delivered':
-        cur.execute(
-            """UPDATE messages 
-            SET status = %s, attempts = %s, last_error = %s, 
-                last_attempt_at = NOW(), completed_at = NOW()
-            WHERE message_id = %s""",
-            (status, attempts, last_error, message_id)
-        )
-    else:
+    for due_condition in [
+        "status = 'queued' ORDER BY created_at",
+        "status = 'retrying' AND next_attempt_at <= NOW() ORDER BY next_attempt_at"
+    ]:
+        if len(claimed) >= limit:
+            break
+        
         cur.execute(
-            """UPDATE messages 
-            SET status = %s, attempts = %s, last_error = %s, last_attempt_at = NOW()
-            WHERE message_id = %s""",
-            (status, attempts, last_error, message_id)
+            f"""UPDATE messages
+            SET status = 'processing', locked_until = NOW() + make_interval(secs => %s),
+                lease_token = %s
+            WHERE id IN (
+                SELECT id FROM messages
+                WHERE {due_condition}
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING message_id, provider, recipient, message_text, payload, attempts, max_attempts,
+                      lease_token""",
+            (WORKER_LEASE_SECONDS, lease_token, limit - len(claimed))
         )
+        claimed.extend(cur.fetchall())
+        conn.commit()
     
-    conn.commit()
     cur.close()
+    
+    return [
+        {**row, 'payload': row['payload'] or {}, 'leased_at': leased_at}
+        for row in claimed
+    ]
 
-def get_wappi_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Получает Wappi credentials и тип провайдера из конфига"""
+def renew_leases(items: List[Dict], conn) -> List[Dict]:
+    """Продлевает аренду сообщений перед отправкой, если прошло больше половины срока
+    Большая пачка доставляется дольше WORKER_LEASE_SECONDS, и без продления
+    release_expired_leases вернул бы в очередь сообщения, которые еще в работе.
+    Продлевается только своя аренда (status processing, тот же lease_token).
+    Возвращает сообщения, аренда которых осталась за этим исполнителем
+    """
+    now = time.time()
+    stale = [item for item in items if now - item['leased_at'] > WORKER_LEASE_SECONDS / 2]
+    if not stale:
+        return items
+    
     cur = conn.cursor()
     cur.execute(
-        "SELECT config, provider_type FROM providers WHERE provider_code = %s",
-        (provider,)
+        """UPDATE messages m
+        SET locked_until = NOW() + make_interval(secs => %s)
+        FROM unnest(%s::text[], %s::text[]) AS v(message_id, lease_token)
+        WHERE m.message_id = v.message_id AND m.status = 'processing'
+          AND m.lease_token = v.lease_token
+        RETURNING m.message_id""",
+        (WORKER_LEASE_SECONDS, [item['message_id'] for item in stale],
+         [item['lease_token'] for item in stale])
     )
-    result = cur.fetchone()
+    renewed = {row['message_id'] for row in cur.fetchall()}
+    conn.commit()
     cur.close()
     
-    if not result or not result['config']:
-        return None, None, None
-    
-    config = result['config']
-    return config.get('wappi_token'), config.get('wappi_profile_id'), result['provider_type']
+    lost = {item['message_id'] for item in stale} - renewed
+    for item in stale:
+        if item['message_id'] in renewed:
+            item['leased_at'] = now
+    return [item for item in items if item['message_id'] not in lost]
 
-def send_via_wappi(recipient: str, message: str, provider: str, conn) -> Tuple[int, str]:
-    """Отправляет сообщение через Wappi API"""
-    try:
-        wappi_token, wappi_profile_id, provider_type = get_wappi_credentials(provider, conn)
-        
-        if not wappi_token or not wappi_profile_id:
-            return 500, json.dumps({"error": "Wappi credentials not configured"})
-        
-        endpoint_map = {
-            'max': 'https://wappi.pro/maxapi/sync/message/send',
-            'telegram_bot': 'https://wappi.pro/tapi/sync/message/send',
-            'whatsapp_business': 'https://wappi.pro/api/sync/message/send',
-            'wappi': 'https://wappi.pro/api/sync/message/send'
-        }
-        
-        api_url = endpoint_map.get(provider_type, 'https://wappi.pro/api/sync/message/send')
-        
-        recipient_clean = recipient.replace('+', '').replace('-', '').replace(' ', '')
-        
-        request_data = json.dumps({
-            'recipient': recipient_clean,
-            'body': message
-        })
-        
-        print(f"[WAPPI] Sending request:")
-        print(f"[WAPPI] Provider code: {provider}")
-        print(f"[WAPPI] Provider type: {provider_type}")
-        print(f"[WAPPI] URL: {api_url}?profile_id={wappi_profile_id}")
-        print(f"[WAPPI] Headers: Authorization: {wappi_token[:10]}...")
-        print(f"[WAPPI] Data: {request_data}")
-        
-        response = requests.post(
-            api_url,
-            params={'profile_id': wappi_profile_id},
-            headers={
-                'Authorization': wappi_token
-            },
-            data=request_data,
-            timeout=10
-        )
-        
-        print(f"[WAPPI] Response status: {response.status_code}")
-        print(f"[WAPPI] Response body: {response.text}")
-        
-        if response.status_code == 200:
-            try:
-                response_data = response.json()
-                if response_data.get('status') == 'done':
-                    return 200, response.text
-                else:
-                    return 500, response.text
-            except:
-                return response.status_code, response.text
-        
-        return response.status_code, response.text
-        
-    except requests.exceptions.Timeout:
-        return 500, json.dumps({"error": "Request timeout"})
-    except requests.exceptions.RequestException as e:
-        return 500, json.dumps({"error": str(e)})
+def get_retry_policy(provider: str, conn) -> Dict[str, float]:
+    """Параметры повторов провайдера из providers.config (retry_max_attempts,
+    retry_base_delay, retry_max_delay), по умолчанию - из переменных окружения
+    """
+    config = get_provider_config(provider, conn) or {}
+    return {
+        'max_attempts': int(config.get('retry_max_attempts', RETRY_MAX_ATTEMPTS)),
+        'base_delay': float(config.get('retry_base_delay', RETRY_BASE_DELAY)),
+        'max_delay': float(config.get('retry_max_delay', RETRY_MAX_DELAY))
+    }
 
-def get_postbox_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Получает Yandex Postbox credentials из конфига"""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT config FROM providers WHERE provider_code = %s",
-        (provider,)
-    )
-    result = cur.fetchone()
-    cur.close()
-    
-    if not result or not result['config']:
-        return None, None, None
-    
-    config = result['config']
-    return config.get('postbox_access_key'), config.get('postbox_secret_key'), config.get('postbox_from_email')
+def get_retry_delay(attempt_number: int, policy: Dict[str, float]) -> float:
+    """Экспоненциальная задержка перед следующей попыткой с jitter (от половины до полной)"""
+    delay = min(policy['max_delay'], policy['base_delay'] * (2 ** (attempt_number - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
 
-def send_via_postbox(recipient: str, message: str, subject: str, provider: str, conn,
-                    template_name: Optional[str] = None, template_data: Optional[Dict] = None) -> Tuple[int, str]:
-    """Отправляет email через Yandex Postbox API (AWS SES compatible)
-    Поддерживает два режима:
-    - Обычная отправка (SendEmail с Simple) - если template_name не указан
-    - Отправка по шаблону (SendEmail с Template) - если указан template_name
+def record_attempt(message_id: str, attempt_number: int, provider: str, outcome: Dict,
+                   message_status: str, conn, new_message: Optional[Dict] = None,
+                   retry_delay: Optional[float] = None, attempts: Optional[int] = None,
+                   lease_token: Optional[str] = None) -> bool:
+    """Пишет попытку в delivery_attempts и состояние сообщения одним запросом и одним commit
+    retry_delay - через сколько секунд назначить следующую попытку (status retrying).
+    new_message - сообщение еще не сохранено (синхронная отправка): вставляется
+    в том же запросе, что и первая попытка.
+    attempts - сколько попыток засчитать сообщению (по умолчанию attempt_number).
+    Строки delivery_attempts нумеруются подряд, отдельно от attempts: ответ 429 пишется
+    попыткой, но бюджет не расходует, и следующая попытка получает следующий номер.
+    lease_token - токен аренды сохраненного сообщения: исход пишется, только пока
+    сообщение в processing под этой арендой.
+    Возвращает False, если аренда потеряна и ничего не записано
     """
-    try:
-        import hashlib
-        import hmac
-        
-        access_key, secret_key, from_email = get_postbox_credentials(provider, conn)
-        
-        if not access_key or not secret_key or not from_email:
-            return 500, json.dumps({"error": "Postbox credentials not configured"})
-        
-        print(f"[POSTBOX] Using Basic Auth with AWS SigV4")
-        print(f"[POSTBOX] From: {from_email}")
-        print(f"[POSTBOX] To: {recipient}")
-        print(f"[POSTBOX] Subject: {subject}")
-        
-        # Подготовка body запроса
-        if template_name:
-            body = json.dumps({
-                "FromEmailAddress": from_email,
-                "Destination": {
-                    "ToAddresses": [recipient]
-                },
-                "Content": {
-                    "Template": {
-                        "TemplateName": template_name,
-                        "TemplateData": json.dumps(template_data or {})
-                    }
-                }
-            })
-        else:
-            body = json.dumps({
-                "FromEmailAddress": from_email,
-                "Destination": {
-                    "ToAddresses": [recipient]
-                },
-                "Content": {
-                    "Simple": {
-                        "Subject": {
-                            "Data": subject,
-                            "Charset": "UTF-8"
-                        },
-                        "Body": {
-                            "Text": {
-                                "Data": message,
-                                "Charset": "UTF-8"
-                            }
-                        }
-                    }
-                }
-            })
-        
-        # AWS Signature V4
-        method = 'POST'
-        service = 'ses'
-        host = 'postbox.cloud.yandex.net'
-        region = 'ru-central1'
-        endpoint = f'https://{host}/v2/email/outbound-emails'
-        content_type = 'application/json'
-        
-        t = datetime.utcnow()
-        amz_date = t.strftime('%Y%m%dT%H%M%SZ')
-        date_stamp = t.strftime('%Y%m%d')
-        
-        canonical_uri = '/v2/email/outbound-emails'
-        canonical_querystring = ''
-        canonical_headers = f'content-type:{content_type}\nhost:{host}\nx-amz-date:{amz_date}\n'
-        signed_headers = 'content-type;host;x-amz-date'
-        payload_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()
-        canonical_request = f'{method}\n{canonical_uri}\n{canonical_querystring}\n{canonical_headers}\n{signed_headers}\n{payload_hash}'
-        
-        algorithm = 'AWS4-HMAC-SHA256'
-        credential_scope = f'{date_stamp}/{region}/{service}/aws4_request'
-        string_to_sign = f'{algorithm}\n{amz_date}\n{credential_scope}\n' + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
-        
-        def sign(key, msg):
-            return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-        
-        k_date = sign(('AWS4' + secret_key).encode('utf-8'), date_stamp)
-        k_region = sign(k_date, region)
-        k_service = sign(k_region, service)
-        k_signing = sign(k_service, 'aws4_request')
-        
-        signature = hmac.new(k_signing, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
-        authorization_header = f'{algorithm} Credential={access_key}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}'
-        
-        headers = {
-            'Content-Type': content_type,
-            'X-Amz-Date': amz_date,
-            'Authorization': authorization_header
-        }
-        
-        print(f"[POSTBOX] Request body: {body}")
-        
-        response = requests.post(
-            endpoint,
-            headers=headers,
-            data=body,
-            timeout=30
-        )
-        
-        print(f"[POSTBOX] Response status: {response.status_code}")
-        print(f"[POSTBOX] Response body: {response.text}")
-        
-        if response.status_code == 200:
-            return 200, response.text
-        else:
-            return response.status_code, response.text
-        
-    except Exception as e:
-        print(f"[POSTBOX ERROR] Unexpected exception:")
-        print(f"[POSTBOX ERROR] Type: {type(e).__name__}")
-        print(f"[POSTBOX ERROR] Message: {str(e)}")
-        import traceback
-        print(f"[POSTBOX ERROR] Traceback: {traceback.format_exc()}")
-        return 500, json.dumps({"error": str(e), "type": type(e).__name__})
-
-def get_apns_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
-    """Получает APNs credentials из конфига"""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT config FROM providers WHERE provider_code = %s",
-        (provider,)
+    attempt_values = (
+        message_id, attempt_number, provider, outcome['status'], outcome['response_code'],
+        outcome['response_body'], outcome['error_message'], outcome['duration_ms']
     )
-    result = cur.fetchone()
-    cur.close()
+    last_error = outcome['error_message']
+    if attempts is None:
+        attempts = attempt_number
     
-    if not result or not result['config']:
-        return None, None, None, None
+    cur = conn.cursor()
     
-    config = result['config']
-    return (config.get('apns_team_id'), config.get('apns_key_id'), 
-            config.get('apns_private_key'), config.get('apns_bundle_id'))
-
-def send_via_apns(recipient: str, message: str, provider: str, conn, 
-                  title: Optional[str] = None, data: Optional[Dict] = None) -> Tuple[int, str]:
-    """Отправляет push-уведомление через Apple Push Notification service (APNs)"""
-    try:
-        import jwt
-        from datetime import datetime, timedelta
-        
-        team_id, key_id, private_key, bundle_id = get_apns_credentials(provider, conn)
-        
-        if not team_id or not key_id or not private_key or not bundle_id:
-            return 500, json.dumps({"error": "APNs credentials not configured"})
-        
-        print(f"[APNS] Sending push notification")
-        print(f"[APNS] Team ID: {team_id}")
-        print(f"[APNS] Key ID: {key_id}")
-        print(f"[APNS] Bundle ID: {bundle_id}")
-        print(f"[APNS] Device Token: {recipient[:20]}...")
-        
-        token_claims = {
-            'iss': team_id,
-            'iat': datetime.utcnow()
-        }
-        
-        token_headers = {
-            'alg': 'ES256',
-            'kid': key_id
-        }
-        
-        auth_token = jwt.encode(
-            token_claims,
-            private_key,
-            algorithm='ES256',
-            headers=token_headers
+    if new_message:
+        cur.execute(
+            """WITH attempt AS (
+                INSERT INTO delivery_attempts 
+                (message_id, attempt_number, provider, status, response_code, 
+                 response_body, error_message, duration_ms, attempted_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
+            )
+            INSERT INTO messages 
+            (message_id, provider, recipient, message_text, metadata, payload, status, attempts,
+             max_attempts, last_error, last_attempt_at, next_attempt_at, completed_at, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(),
+                    NOW() + make_interval(secs => %s),
+                    CASE WHEN %s = 'delivered' THEN NOW() END, NOW())""",
+            attempt_values + (
+                message_id, provider, new_message['recipient'], new_message['message_text'],
+                json.dumps(new_message['metadata']), json.dumps(new_message['payload']),
+                message_status, attempts, new_message['max_attempts'], last_error,
+                retry_delay, message_status
+            )
         )
-        
-        apns_url = f"https://api.push.apple.com/3/device/{recipient}"
-        
-        payload = {
-            "aps": {
-                "alert": {
-                    "body": message
-                },
-                "sound": "default"
-            }
-        }
-        
-        if title:
-            payload["aps"]["alert"]["title"] = title
-        
-        if data:
-            payload.update(data)
-        
-        print(f"[APNS] URL: {apns_url}")
-        print(f"[APNS] Payload: {json.dumps(payload)}")
-        
-        response = requests.post(
-            apns_url,
-            headers={
-                'authorization': f'bearer {auth_token}',
-                'apns-topic': bundle_id,
-                'apns-push-type': 'alert',
-                'apns-priority': '10'
-            },
-            json=payload,
-            timeout=10
+    else:
+        cur.execute(
+            """WITH updated AS (
+                UPDATE messages 
+                SET status = %s, attempts = %s, last_error = %s, last_attempt_at = NOW(),
+                    next_attempt_at = NOW() + make_interval(secs => %s),
+                    locked_until = NULL, lease_token = NULL,
+                    completed_at = CASE WHEN %s = 'delivered' THEN NOW() ELSE completed_at END
+                WHERE message_id = %s AND status = 'processing' AND lease_token = %s
+                RETURNING message_id
+            )
+            INSERT INTO delivery_attempts 
+            (message_id, attempt_number, provider, status, response_code, 
+             response_body, error_message, duration_ms, attempted_at)
+            SELECT u.message_id,
+                   (SELECT COALESCE(MAX(a.attempt_number), 0) + 1 FROM delivery_attempts a
+                    WHERE a.message_id = u.message_id),
+                   %s, %s, %s, %s, %s, %s, NOW()
+            FROM updated u""",
+            (message_status, attempts, last_error, retry_delay, message_status,
+             message_id, lease_token) + attempt_values[2:]
         )
-        
-        print(f"[APNS] Response status: {response.status_code}")
-        print(f"[APNS] Response body: {response.text}")
-        
-        if response.status_code == 200:
-            return 200, json.dumps({"success": True, "apns_id": response.headers.get('apns-id')})
-        else:
-            return response.status_code, response.text
-        
-    except ImportError:
-        return 500, json.dumps({"error": "PyJWT library not installed"})
-    except Exception as e:
-        print(f"[APNS ERROR] {str(e)}")
-        return 500, json.dumps({"error": str(e)})
+        if cur.rowcount == 0:
+            conn.rollback()
+            cur.close()
+            return False
+    
+    conn.commit()
+    cur.close()
+    return True
 
-def get_fcm_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Получает FCM credentials из конфига"""
+def defer_message(message_id: str, provider: str, attempts: int, retry_delay: float,
+                  error: str, conn, new_message: Optional[Dict] = None,
+                  lease_token: Optional[str] = None) -> bool:
+    """Откладывает сообщение (лимит провайдера, открытая цепь) без записи попытки:
+    status retrying, следующая попытка через retry_delay секунд, attempts не меняется.
+    Как и record_attempt, возвращает False, если аренда lease_token потеряна
+    """
     cur = conn.cursor()
-    cur.execute(
-        "SELECT config FROM providers WHERE provider_code = %s",
-        (provider,)
-    )
-    result = cur.fetchone()
-    cur.close()
-    
-    if not result or not result['config']:
-        return None, None, None
     
-    config = result['config']
-    return (config.get('fcm_project_id'), config.get('fcm_private_key'), 
-            config.get('fcm_client_email'))
-
-def send_via_fcm(recipient: str, message: str, provider: str, conn,
-                 title: Optional[str] = None, data: Optional[Dict] = None) -> Tuple[int, str]:
-    """Отправляет push-уведомление через Firebase Cloud Messaging (FCM)"""
-    try:
-        from google.oauth2 import service_account
-        from google.auth.transport.requests import Request
-        
-        project_id, private_key, client_email = get_fcm_credentials(provider, conn)
-        
-        if not project_id or not private_key or not client_email:
-            return 500, json.dumps({"error": "FCM credentials not configured"})
-        
-        print(f"[FCM] Sending push notification")
-        print(f"[FCM] Project ID: {project_id}")
-        print(f"[FCM] Device Token: {recipient[:20]}...")
-        
-        credentials_dict = {
-            "type": "service_account",
-            "project_id": project_id,
-            "private_key": private_key,
-            "client_email": client_email,
-            "token_uri": "https://oauth2.googleapis.com/token"
-        }
-        
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_dict,
-            scopes=['https://www.googleapis.com/auth/firebase.messaging']
+    if new_message:
+        cur.execute(
+            """INSERT INTO messages 
+            (message_id, provider, recipient, message_text, metadata, payload, status, attempts,
+             max_attempts, last_error, next_attempt_at, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, 'retrying', %s, %s, %s,
+                    NOW() + make_interval(secs => %s), NOW())""",
+            (message_id, provider, new_message['recipient'], new_message['message_text'],
+             json.dumps(new_message['metadata']), json.dumps(new_message['payload']),
+             attempts, new_message['max_attempts'], error, retry_delay)
         )
-        credentials.refresh(Request())
-        
-        fcm_url = f"https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
-        
-        payload = {
-            "message": {
-                "token": recipient,
-                "notification": {
-                    "body": message
-                }
-            }
-        }
-        
-        if title:
-            payload["message"]["notification"]["title"] = title
-        
-        if data:
-            payload["message"]["data"] = {k: str(v) for k, v in data.items()}
-        
-        print(f"[FCM] URL: {fcm_url}")
-        print(f"[FCM] Payload: {json.dumps(payload)}")
-        
-        response = requests.post(
-            fcm_url,
-            headers={
-                'Authorization': f'Bearer {credentials.token}',
-                'Content-Type': 'application/json'
-            },
-            json=payload,
-            timeout=10
+    else:
+        cur.execute(
+            """UPDATE messages 
+            SET status = 'retrying', attempts = %s, last_error = %s,
+                next_attempt_at = NOW() + make_interval(secs => %s),
+                locked_until = NULL, lease_token = NULL
+            WHERE message_id = %s AND status = 'processing' AND lease_token = %s""",
+            (attempts, error, retry_delay, message_id, lease_token)
         )
-        
-        print(f"[FCM] Response status: {response.status_code}")
-        print(f"[FCM] Response body: {response.text}")
-        
-        if response.status_code == 200:
-            return 200, response.text
-        else:
-            return response.status_code, response.text
-        
-    except ImportError:
-        return 500, json.dumps({"error": "Google libraries not installed"})
-    except Exception as e:
-        print(f"[FCM ERROR] {str(e)}")
-        return 500, json.dumps({"error": str(e)})
-
-def get_smsaero_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Получает SMS Aero credentials из конфига"""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT config FROM providers WHERE provider_code = %s",
-        (provider,)
-    )
-    result = cur.fetchone()
+        if cur.rowcount == 0:
+            conn.rollback()
+            cur.close()
+            return False
+    
+    conn.commit()
     cur.close()
+    return True
 
-    if not result or not result['config']:
-        return None, None, None
-
-    config = result['config']
-    return config.get('smsaero_email'), config.get('smsaero_api_key'), config.get('smsaero_sign')
-
-
-def send_via_smsaero(recipient: str, message: str, provider: str, conn) -> Tuple[int, str]:
-    """Отправляет SMS через SMS Aero API"""
-    import base64
-
-    email, api_key, sign = get_smsaero_credentials(provider, conn)
-
-    if not email or not api_key or not sign:
-        return 500, json.dumps({"error": "SMS Aero credentials not configured"})
-
-    credentials = base64.b64encode(f"{email}:{api_key}".encode()).decode()
+def finish_attempt(message_id: str, provider: str, outcome: Dict, attempt_number: int,
+                   max_attempts: Optional[int], conn, new_message: Optional[Dict] = None,
+                   lease_token: Optional[str] = None) -> Tuple[str, int, Optional[str]]:
+    """Фиксирует исход попытки доставки (один запрос, один commit)
+    При неудаче, пока не исчерпан max_attempts, назначает следующую попытку
+    через next_attempt_at - ее выполнит воркер, без ожидания в этом вызове.
+    Постоянная ошибка (получатель больше не зарегистрирован) сразу дает failed.
+    Упор в лимит и открытая цепь провайдера попыткой не считаются: сообщение
+    откладывается на retry_after.
+    Если аренда lease_token истекла и сообщение забрал другой исполнитель, исход
+    не пишется, а статус - processing: сообщением уже занимается тот, кто его забрал.
+    Возвращает (статус delivered|retrying|failed|processing, номер попытки, ошибка)
+    """
+    if max_attempts is None:
+        max_attempts = get_retry_policy(provider, conn)['max_attempts']
+    
+    if outcome['status'] in DEFERRED_OUTCOMES:
+        # Упор в лимит или открытая цепь провайдера не расходуют попытку - сообщение откладывается
+        if outcome['response_code'] is None:
+            recorded = defer_message(message_id, provider, attempt_number - 1, outcome['retry_after'],
+                                     outcome['error_message'], conn, new_message=new_message,
+                                     lease_token=lease_token)
+        else:
+            recorded = record_attempt(message_id, attempt_number, provider, outcome, 'retrying', conn,
+                                      new_message=new_message, retry_delay=outcome['retry_after'],
+                                      attempts=attempt_number - 1, lease_token=lease_token)
+        if not recorded:
+            return lease_lost(message_id, attempt_number - 1)
+        return 'retrying', attempt_number - 1, outcome['error_message']
+    
+    retry_delay = None
+    if outcome['status'] == 'success':
+        message_status = 'delivered'
+    elif attempt_number < max_attempts and not outcome.get('permanent'):
+        message_status = 'retrying'
+        retry_delay = get_retry_delay(attempt_number, get_retry_policy(provider, conn))
+    else:
+        message_status = 'failed'
+    
+    if not record_attempt(message_id, attempt_number, provider, outcome, message_status, conn,
+                          new_message=new_message, retry_delay=retry_delay, lease_token=lease_token):
+        return lease_lost(message_id, attempt_number - 1)
+    
+    return message_status, attempt_number, outcome['error_message']
 
-    phone = recipient.replace('+', '').replace('-', '').replace(' ', '').replace('(', '').replace(')', '')
+def lease_lost(message_id: str, attempts: int) -> Tuple[str, int, Optional[str]]:
+    """Исход для сообщения, чья аренда истекла до записи результата"""
+    print(f"[WORKER] {message_id}: lease lost, outcome discarded")
+    return 'processing', attempts, 'Lease expired, message was requeued'
 
-    print(f"[SMSAERO] Sending SMS to {phone}")
+def build_processing_insert(message_id: str, provider: str, new_message: Dict,
+                            lease_token: str) -> Tuple[str, tuple]:
+    """INSERT сообщения в processing с арендой WORKER_LEASE_SECONDS - до обращения к провайдеру
+    Если вызов оборвется во время отправки, строка уже есть, а release_expired_leases
+    вернет ее в очередь
+    """
+    return (
+        """INSERT INTO messages 
+        (message_id, provider, recipient, message_text, metadata, payload, status, attempts,
+         max_attempts, locked_until, lease_token, created_at)
+        VALUES (%s, %s, %s, %s, %s, %s, 'processing', 0, %s,
+                NOW() + make_interval(secs => %s), %s, NOW())""",
+        (message_id, provider, new_message['recipient'], new_message['message_text'],
+         json.dumps(new_message['metadata']), json.dumps(new_message['payload']),
+         new_message['max_attempts'], WORKER_LEASE_SECONDS, lease_token)
+    )
 
-    response = requests.post(
-        'https://gate.smsaero.ru/v2/sms/send',
-        headers={
-            'Authorization': f'Basic {credentials}',
-            'Content-Type': 'application/json'
-        },
-        json={
-            'number': phone,
-            'sign': sign,
-            'text': message,
-            'channel': 'DIRECT'
-        },
-        timeout=15
+def deliver_message(message_id: str, provider: str, recipient: str,
+                    message_text: str, conn,
+                    template_name: Optional[str] = None, template_data: Optional[Dict] = None,
+                    subject: Optional[str] = None, title: Optional[str] = None,
+                    data: Optional[Dict] = None, attempt_number: int = 1,
+                    max_attempts: Optional[int] = None, new_message: Optional[Dict] = None,
+                    lease_token: Optional[str] = None) -> Tuple[str, int, Optional[str]]:
+    """Делает одну попытку доставки и фиксирует ее исход через finish_attempt
+    new_message - данные еще не сохраненного сообщения: перед обращением к провайдеру
+    оно вставляется в processing тем же запросом, что резервирует токен rate limit.
+    Если до провайдера дело не дошло (открытая цепь, упор в конкурентность), сообщение
+    вставляется вместе с исходом.
+    lease_token - токен аренды уже сохраненного сообщения (из claim_messages, save_messages)
+    Возвращает (статус delivered|retrying|failed|processing, номер попытки, ошибка)
+    """
+    claim = None
+    if new_message:
+        lease_token = uuid.uuid4().hex
+        claim = build_processing_insert(message_id, provider, new_message, lease_token)
+    outcome = attempt_delivery(
+        provider, recipient, message_text, conn,
+        template_name=template_name, template_data=template_data, subject=subject,
+        title=title, data=data, claim=claim
     )
+    if outcome.get('claimed'):
+        new_message = None
+    return finish_attempt(message_id, provider, outcome, attempt_number, max_attempts, conn,
+                          new_message=new_message, lease_token=lease_token)
 
-    print(f"[SMSAERO] Response status: {response.status_code}")
-    print(f"[SMSAERO] Response body: {response.text}")
+def deliver_batch_item(item: Dict, semaphore: threading.Semaphore) -> Tuple[str, int, Optional[str]]:
+    """Доставляет одно сообщение из пачки на собственном соединении из пула
+    Если соединения нет или запись исхода упала, сообщение остается в processing
+    под арендой - его подберет воркер, поэтому и статус processing
+    """
+    with semaphore:
+        conn = None
+        try:
+            conn = get_db_connection()
+            if not renew_leases([item], conn):
+                return lease_lost(item['message_id'], item.get('attempts', 0))
+            payload = item['payload']
+            return deliver_message(
+                item['message_id'], item['provider'], item['recipient'], item['message_text'], conn,
+                template_name=payload.get('template_name'), template_data=payload.get('template_data'),
+                subject=payload.get('subject'), title=payload.get('title'), data=payload.get('data'),
+                attempt_number=item.get('attempts', 0) + 1, max_attempts=item.get('max_attempts'),
+                lease_token=item.get('lease_token')
+            )
+        except Exception as e:
+            return 'processing', item.get('attempts', 0), str(e)
+        finally:
+            release_db_connection(conn)
 
-    if response.status_code == 200:
-        data = response.json()
-        if data.get('success'):
-            return 200, response.text
+def deliver_group(items: List[Dict], semaphore: threading.Semaphore) -> Dict[str, Tuple[str, int, Optional[str]]]:
+    """Доставляет одинаковое сообщение группе получателей одним batch-вызовом провайдера
+    на собственном соединении из пула; исход по каждому получателю пишется в его сообщение.
+    Сообщения, аренду которых продлить не удалось, не отправляются
+    """
+    if len(items) == 1:
+        return {items[0]['message_id']: deliver_batch_item(items[0], semaphore)}
+    
+    with semaphore:
+        conn = None
+        results = {}
+        try:
+            conn = get_db_connection()
+            owned = renew_leases(items, conn)
+            for item in items:
+                if item not in owned:
+                    results[item['message_id']] = lease_lost(item['message_id'], item.get('attempts', 0))
+            items = owned
+            if not items:
+                return results
+            
+            first = items[0]
+            payload = first['payload']
+            outcomes = attempt_batch_delivery(
+                first['provider'], [item['recipient'] for item in items], first['message_text'], conn,
+                template_name=payload.get('template_name'), template_data=payload.get('template_data'),
+                subject=payload.get('subject'), title=payload.get('title'), data=payload.get('data'),
+                recipient_options={item['recipient']: item['payload'] for item in items}
+            )
+            
+            for item in items:
+                try:
+                    results[item['message_id']] = finish_attempt(
+                        item['message_id'], item['provider'], outcomes[item['recipient']],
+                        item.get('attempts', 0) + 1, item.get('max_attempts'), conn,
+                        lease_token=item.get('lease_token')
+                    )
+                except Exception as e:
+                    conn.rollback()
+                    results[item['message_id']] = ('processing', item.get('attempts', 0), str(e))
+            return results
+        except Exception as e:
+            return {
+                **results,
+                **{item['message_id']: ('processing', item.get('attempts', 0), str(e)) for item in items}
+            }
+        finally:
+            release_db_connection(conn)
+
+def group_messages(messages: List[Dict], conn) -> List[List[Dict]]:
+    """Разбивает сообщения на группы для отправки
+    Сообщения с одинаковыми провайдером, текстом и параметрами доставки для адаптеров
+    с batch-транспортом собираются в группы до batch_size разных получателей,
+    остальные идут по одному. Поля per_recipient адаптера (например, template_data
+    писем) могут различаться внутри группы.
+    """
+    groups: List[List[Dict]] = []
+    open_groups: Dict[Tuple[str, str, str], List[List[Dict]]] = {}
+    
+    for message in messages:
+        adapter = get_provider_adapter(message['provider'], conn)
+        if not adapter or not adapter['batch']:
+            groups.append([message])
+            continue
+        
+        shared_payload = {
+            field: value for field, value in message['payload'].items()
+            if field not in adapter.get('per_recipient', [])
+        }
+        key = (message['provider'], message['message_text'], json.dumps(shared_payload, sort_keys=True))
+        candidates = open_groups.setdefault(key, [])
+        
+        for group in candidates:
+            if len(group) < adapter['batch_size'] and all(m['recipient'] != message['recipient'] for m in group):
+                group.append(message)
+                break
         else:
-            return 500, response.text
-    return response.status_code, response.text
+            group = [message]
+            candidates.append(group)
+            groups.append(group)
+    
+    return groups
 
+def get_provider_concurrency(provider: str, conn) -> int:
+    """Сколько отправок к провайдеру допустимо одновременно: max_concurrency из config
+    провайдера или адаптера, для не интегрированных провайдеров - BATCH_PROVIDER_CONCURRENCY
+    """
+    return get_provider_limits(provider, conn)['max_concurrency'] or BATCH_PROVIDER_CONCURRENCY
 
-def simulate_provider_send(provider: str, recipient: str, message: str) -> Tuple[int, str]:
-    """Симулирует отправку через провайдера (заглушка для не интегрированных провайдеров)"""
-    time.sleep(0.1)
-    
-    import random
-    success_rate = 0.8
+def dispatch_messages(messages: List[Dict], conn) -> Dict[str, Tuple[str, int, Optional[str]]]:
+    """Параллельно доставляет сохраненные сообщения
+    Одинаковые сообщения многим получателям уходят batch-вызовами (group_messages).
+    Одновременно по каждому провайдеру идет не больше его max_concurrency вызовов.
+    Соединение вызывающего потока тоже занято, поэтому потоков не больше, чем свободных в пуле.
+    Возвращает {message_id: (статус, номер попытки, ошибка)}
+    """
+    limits = {
+        provider: get_provider_concurrency(provider, conn)
+        for provider in {m['provider'] for m in messages}
+    }
+    semaphores = {provider: threading.Semaphore(limit) for provider, limit in limits.items()}
+    max_workers = max(1, min(DB_POOL_MAX - 1, sum(limits.values())))
     
-    if random.random() < success_rate:
-        return 200, json.dumps({"success": True, "message_id": str(uuid.uuid4())})
-    else:
-        return 500, json.dumps({"success": False, "error": "Provider temporary unavailable"})
+    results: Dict[str, Tuple[str, int, Optional[str]]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(deliver_group, group, semaphores[group[0]['provider']])
+            for group in group_messages(messages, conn)
+        ]
+        for future in futures:
+            results.update(future.result())
+    return results
 
-def attempt_delivery(message_id: str, provider: str, recipient: str, 
-                    message_text: str, attempt_number: int, conn,
-                    template_name: Optional[str] = None, template_data: Optional[Dict] = None,
-                    subject: Optional[str] = None, title: Optional[str] = None,
-                    data: Optional[Dict] = None) -> Tuple[bool, Optional[str]]:
-    """Пытается доставить сообщение"""
-    start_time = time.time()
+def process_queue(conn, limit: int = 50) -> Dict[str, int]:
+    """Воркер доставки: забирает новые сообщения и наступившие повторы пачками
+    по WORKER_BATCH_SIZE и доставляет их параллельно. Можно запускать сколько угодно экземпляров.
+    """
+    stats = {'processed': 0, 'delivered': 0, 'retrying': 0, 'failed': 0, 'processing': 0}
     
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT provider_type FROM providers WHERE provider_code = %s", (provider,))
-        result = cur.fetchone()
-        cur.close()
-        
-        provider_type = result['provider_type'] if result else None
+    released = release_expired_leases(conn)
+    if released:
+        print(f"[WORKER] Requeued {released} messages with expired lease")
+    
+    while stats['processed'] < limit:
+        claimed = claim_messages(min(WORKER_BATCH_SIZE, limit - stats['processed']), conn)
+        if not claimed:
+            break
+        
+        for message_id, (status, attempt, error) in dispatch_messages(claimed, conn).items():
+            stats['processed'] += 1
+            stats[status] += 1
+            print(f"[WORKER] {message_id} -> {status} (attempt {attempt})")
+    
+    return stats
+
+def run_worker(idle_sleep: float = 1.0) -> None:
+    """Бесконечный цикл воркера для выделенных машин (вне облачной функции)"""
+    while True:
+        conn = get_db_connection()
+        try:
+            stats = process_queue(conn, WORKER_BATCH_SIZE)
+        finally:
+            release_db_connection(conn)
         
-        if provider_type in ['whatsapp_business', 'telegram_bot', 'wappi', 'max']:
-            status_code, response_body = send_via_wappi(recipient, message_text, provider, conn)
-        elif provider_type == 'yandex_postbox':
-            email_subject = subject or "Уведомление"
-            status_code, response_body = send_via_postbox(
-                recipient, message_text, email_subject, provider, conn,
-                template_name=template_name, template_data=template_data
-            )
-        elif provider_type == 'fcm':
-            status_code, response_body = send_via_fcm(recipient, message_text, provider, conn, 
-                                                      title=title, data=data)
-        elif provider_type == 'apns':
-            status_code, response_body = send_via_apns(recipient, message_text, provider, conn,
-                                                       title=title, data=data)
-        elif provider_type == 'sms_aero':
-            status_code, response_body = send_via_smsaero(recipient, message_text, provider, conn)
-        else:
-            status_code, response_body = simulate_provider_send(provider, recipient, message_text)
+        if not stats['processed']:
+            time.sleep(idle_sleep)
+
+def expand_recipients(body_data: Dict) -> List[Dict]:
+    """Разворачивает рассылку одного сообщения (recipients) в элементы пачки
+    Элемент recipients - адрес строкой или объект со своими recipient, template_data, metadata...
+    Остальные поля берутся из тела запроса.
+    """
+    shared = {
+        key: body_data[key]
+        for key in ['provider', 'message', 'metadata', 'subject', 'template_name', 'template_data', 'title', 'data']
+        if key in body_data
+    }
+    return [
+        {**shared, **entry} if isinstance(entry, dict) else {**shared, 'recipient': entry}
+        for entry in body_data['recipients']
+    ]
+
+def send_batch(items: List[Dict], async_mode: bool, conn) -> Dict[str, Any]:
+    """Принимает пачку сообщений: проверка, один INSERT на всю пачку и параллельная доставка
+    Одновременно по каждому провайдеру идет не больше его max_concurrency.
+    Возвращает результат по каждому элементу в порядке запроса.
+    """
+    results: List[Dict[str, Any]] = []
+    accepted: List[Dict] = []
+    
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not all([item.get('provider'), item.get('recipient'), item.get('message')]):
+            results.append({
+                'index': index,
+                'status': 'rejected',
+                'error': 'Missing required fields',
+                'required': ['provider', 'recipient', 'message']
+            })
+            continue
         
-        duration_ms = int((time.time() - start_time) * 1000)
+        provider = item['provider']
+        is_active, provider_name = check_provider_active(provider, conn)
         
-        if status_code == 200:
-            log_attempt(message_id, attempt_number, provider, 'success', 
-                       status_code, response_body, None, duration_ms, conn)
-            return True, None
+        if not provider_name or not is_active:
+            results.append({
+                'index': index,
+                'provider': provider,
+                'status': 'rejected',
+                'error': 'Unknown provider' if not provider_name else 'Provider inactive'
+            })
+            continue
+        
+        message = {
+            'message_id': f"msg_{uuid.uuid4().hex[:16]}",
+            'provider': provider,
+            'max_attempts': get_retry_policy(provider, conn)['max_attempts'],
+            'recipient': item['recipient'],
+            'message_text': item['message'],
+            'metadata': item.get('metadata', {}),
+            'payload': {
+                'template_name': item.get('template_name'),
+                'template_data': item.get('template_data'),
+                'subject': item.get('subject'),
+                'title': item.get('title'),
+                'data': item.get('data')
+            }
+        }
+        accepted.append(message)
+        results.append({'index': index, 'message_id': message['message_id'], 'provider': provider})
+    
+    if accepted:
+        if async_mode:
+            save_messages(accepted, 'queued', conn)
         else:
-            error_msg = f"Provider returned status {status_code}"
-            log_attempt(message_id, attempt_number, provider, 'failed', 
-                       status_code, response_body, error_msg, duration_ms, conn)
-            return False, error_msg
-            
-    except Exception as e:
-        duration_ms = int((time.time() - start_time) * 1000)
-        error_msg = str(e)
-        log_attempt(message_id, attempt_number, provider, 'error', 
-                   None, '', error_msg, duration_ms, conn)
-        return False, error_msg
+            # Доставляем сами, под арендой: недоставленный из-за обрыва остаток подберет воркер
+            lease_token = uuid.uuid4().hex
+            save_messages(accepted, 'processing', conn, lease_seconds=WORKER_LEASE_SECONDS,
+                          lease_token=lease_token)
+            for message in accepted:
+                message.update({'lease_token': lease_token, 'leased_at': time.time()})
+    
+    by_message_id = {r['message_id']: r for r in results if 'message_id' in r}
+    
+    if async_mode:
+        for r in by_message_id.values():
+            r['status'] = 'queued'
+    elif accepted:
+        for message_id, (status, attempts, error) in dispatch_messages(accepted, conn).items():
+            by_message_id[message_id].update({
+                'status': status,
+                'attempts': attempts,
+                'error': error
+            })
+    
+    summary = {'total': len(items)}
+    for status in ['delivered', 'retrying', 'failed', 'processing', 'queued', 'rejected']:
+        summary[status] = sum(1 for r in results if r['status'] == status)
+    
+    return {'results': results, **summary}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Обрабатывает запросы на отправку сообщений с гарантированной доставкой.
-    Поддерживает retry механизм с экспоненциальной задержкой.
+    Первая попытка выполняется сразу, повторы (экспоненциальная задержка с jitter,
+    настраивается в config провайдера) назначаются через next_attempt_at и выполняются воркером.
     
     POST /api/send
     Body: {
@@ -644,9 +812,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         "metadata": {} (опционально),
         "subject": "Тема письма" (опционально, для email),
         "template_name": "имя_шаблона" (опционально, для Postbox),
-        "template_data": {"key": "value"} (опционально, данные для шаблона)
+        "template_data": {"key": "value"} (опционально, данные для шаблона),
+        "async": true (опционально, только поставить в очередь и сразу вернуть 202)
     }
     
+    POST /api/send/batch (или ?action=batch) - пакетная отправка
+        Body: {"messages": [{"provider": ..., "recipient": ..., "message": ...}, ...], "async": false}
+        или рассылка одного сообщения: {"provider": ..., "message": ..., "template_name": ...,
+        "recipients": ["a@b.ru", {"recipient": "c@d.ru", "template_data": {...}}, ...]}
+        Возвращает message_id и статус по каждому элементу
+    
+    POST /api/send?action=worker - воркер доставки (вызывается по таймеру),
+        обрабатывает сообщения из очереди и наступившие повторы. Body: {"limit": 50} (опционально)
+    
     Для Yandex Postbox:
     - Если указан template_name - отправка по шаблону (SendEmail с Template)
     - Если template_name не указан - обычное письмо (SendEmail с Simple)
@@ -678,6 +856,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -693,7 +872,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn = get_db_connection()
         
         if not verify_api_key(api_key, conn):
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -701,7 +880,58 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        body_data = json.loads(event.get('body', '{}'))
+        body_data = json.loads(event.get('body') or '{}')
+        params = event.get('queryStringParameters') or {}
+        
+        if params.get('action') == 'worker':
+            limit = min(max(int(body_data.get('limit', 50)), 1), 500)
+            stats = process_queue(conn, limit)
+            release_db_connection(conn)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, **stats}),
+                'isBase64Encoded': False
+            }
+        
+        path = event.get('path', '')
+        if path.rstrip('/').endswith('/batch') or params.get('action') == 'batch':
+            items = body_data.get('messages')
+            if items is None and isinstance(body_data.get('recipients'), list):
+                items = expand_recipients(body_data)
+            
+            if not isinstance(items, list) or not items:
+                release_db_connection(conn)
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Missing messages', 'required': ['messages']}),
+                    'isBase64Encoded': False
+                }
+            
+            if len(items) > BATCH_MAX_SIZE:
+                release_db_connection(conn)
+                return {
+                    'statusCode': 413,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Batch too large', 'max_size': BATCH_MAX_SIZE}),
+                    'isBase64Encoded': False
+                }
+            
+            async_mode = bool(body_data.get('async', False))
+            batch_result = send_batch(items, async_mode, conn)
+            release_db_connection(conn)
+            
+            return {
+                'statusCode': 202 if async_mode else 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': batch_result['rejected'] == 0 and batch_result['failed'] == 0,
+                    **batch_result
+                }),
+                'isBase64Encoded': False
+            }
         
         provider = body_data.get('provider')
         recipient = body_data.get('recipient')
@@ -712,9 +942,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         subject = body_data.get('subject')
         title = body_data.get('title')
         data = body_data.get('data')
+        async_mode = bool(body_data.get('async', False))
         
         if not all([provider, recipient, message_text]):
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -728,7 +959,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         is_active, provider_name = check_provider_active(provider, conn)
         
         if not provider_name:
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -741,7 +972,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         if not is_active:
-            conn.close()
+            release_db_connection(conn)
             return {
                 'statusCode': 503,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -755,44 +986,95 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         message_id = f"msg_{uuid.uuid4().hex[:16]}"
+        payload = {
+            'template_name': template_name,
+            'template_data': template_data,
+            'subject': subject,
+            'title': title,
+            'data': data
+        }
         
-        save_message(message_id, provider, recipient, message_text, metadata, conn)
-        
-        max_attempts = 3
-        retry_delays = [0, 1, 3]
+        max_attempts = get_retry_policy(provider, conn)['max_attempts']
         
-        last_error = None
-        for attempt in range(1, max_attempts + 1):
-            if attempt > 1:
-                time.sleep(retry_delays[attempt - 1])
-            
-            success, error = attempt_delivery(
-                message_id, provider, recipient, message_text, attempt, conn,
-                template_name=template_name, template_data=template_data, subject=subject,
-                title=title, data=data
-            )
+        if async_mode:
+            save_message(message_id, provider, recipient, message_text, metadata, conn,
+                         status='queued', payload=payload, max_attempts=max_attempts)
+            release_db_connection(conn)
             
-            if success:
-                update_message_status(message_id, 'delivered', attempt, None, conn)
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'message_id': message_id,
-                        'provider': provider,
-                        'status': 'delivered',
-                        'attempts': attempt
-                    }),
-                    'isBase64Encoded': False
-                }
-            
-            last_error = error
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': 'queued'
+                }),
+                'isBase64Encoded': False
+            }
+        
+        # Сообщение сохраняется в processing до отправки (вместе с резервированием токена),
+        # исход первой попытки пишется одним запросом
+        new_message = {
+            'recipient': recipient,
+            'message_text': message_text,
+            'metadata': metadata,
+            'payload': payload,
+            'max_attempts': max_attempts
+        }
+        status, attempts, last_error = deliver_message(
+            message_id, provider, recipient, message_text, conn,
+            template_name=template_name, template_data=template_data, subject=subject,
+            title=title, data=data, max_attempts=max_attempts, new_message=new_message
+        )
+        release_db_connection(conn)
+        
+        if status == 'delivered':
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': 'delivered',
+                    'attempts': attempts
+                }),
+                'isBase64Encoded': False
+            }
         
-        update_message_status(message_id, 'failed', max_attempts, last_error, conn)
-        conn.close()
+        if status == 'processing':
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': False,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': 'processing',
+                    'attempts': attempts,
+                    'error': last_error,
+                    'message': 'Delivery outcome was not recorded, the worker will pick the message up.'
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if status == 'retrying':
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': False,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': 'retrying',
+                    'attempts': attempts,
+                    'max_attempts': max_attempts,
+                    'error': last_error,
+                    'message': 'Delivery failed, next attempt is scheduled.'
+                }),
+                'isBase64Encoded': False
+            }
         
         return {
             'statusCode': 500,
@@ -802,9 +1084,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'message_id': message_id,
                 'provider': provider,
                 'status': 'failed',
-                'attempts': max_attempts,
+                'attempts': attempts,
                 'error': last_error,
-                'message': f'Failed to deliver after {max_attempts} attempts. Message saved for manual retry.'
+                'message': f'Failed to deliver after {attempts} attempts. Message saved for manual retry.'
             }),
             'isBase64Encoded': False
         }
@@ -822,4 +1104,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
+    finally:
+        release_db_connection(conn)
+
+
+if __name__ == '__main__':
+    # Выделенный воркер: python index.py [число процессов], по умолчанию - по ядру на процесс
+    import sys
+    from multiprocessing import Process
+    
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else (os.cpu_count() or 1)
+    workers = [Process(target=run_worker) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
\ No newline at end of file
@@ -1,21 +1,115 @@
 import json
 import os
+import time
 import asyncio
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '30'))
+TG_CLIENT_TIMEOUT = int(os.environ.get('TG_CLIENT_TIMEOUT', '30'))
+OTP_PURGE_INTERVAL = int(os.environ.get('OTP_PURGE_INTERVAL', '60'))
+OTP_PURGE_BATCH = int(os.environ.get('OTP_PURGE_BATCH', '500'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+# Ключи, успешно прошедшие проверку: {api_key: время проверки}
+_api_key_cache: Dict[str, float] = {}
+
+# Фоновый event loop, в котором клиенты Telethon живут между warm-вызовами
+_tg_loop = None
+_tg_loop_lock = threading.Lock()
+# Подключённые клиенты по провайдерам: {provider_code: (api_id, api_hash, session_str, client)}
+_tg_clients: Dict[str, tuple] = {}
+_tg_client_locks: Dict[str, asyncio.Lock] = {}
+
+# Время последней очистки просроченных OTP-сессий этим инстансом
+_otp_purged_at = 0.0
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def release_db_connection(conn) -> None:
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
 
 def verify_api_key(api_key: str, conn) -> bool:
+    checked_at = _api_key_cache.get(api_key)
+    if checked_at and time.time() - checked_at < API_KEY_CACHE_TTL:
+        return True
     cur = conn.cursor()
     cur.execute("SELECT id FROM api_keys WHERE api_key = %s AND is_active = true", (api_key,))
     result = cur.fetchone()
     cur.close()
-    return result is not None
+    if not result:
+        _api_key_cache.pop(api_key, None)
+        return False
+    _api_key_cache[api_key] = time.time()
+    return True
 
 def get_tg_credentials(provider_code: str, conn):
     cur = conn.cursor()
@@ -27,12 +121,87 @@ def get_tg_credentials(provider_code: str, conn):
     config = result['config']
     return config.get('tg_api_id'), config.get('tg_api_hash'), config.get('tg_session', '')
 
-async def send_code(api_id: int, api_hash: str, session_str: str, phone: str):
-    client = TelegramClient(StringSession(session_str), api_id, api_hash)
-    await client.connect()
+def save_otp_session(provider_code: str, phone: str, phone_code_hash: str, conn) -> None:
+    cur = conn.cursor()
+    # Повторный запрос кода заменяет сессию номера и продлевает срок её жизни
+    cur.execute(
+        """INSERT INTO tg_otp_sessions (provider_code, phone, phone_code_hash) VALUES (%s, %s, %s)
+           ON CONFLICT (provider_code, phone) DO UPDATE
+           SET phone_code_hash = EXCLUDED.phone_code_hash,
+               created_at = EXCLUDED.created_at,
+               expires_at = EXCLUDED.expires_at""",
+        (provider_code, phone, phone_code_hash)
+    )
+    cur.close()
+
+def purge_expired_otp_sessions(conn) -> int:
+    global _otp_purged_at
+    if time.time() - _otp_purged_at < OTP_PURGE_INTERVAL:
+        return 0
+    _otp_purged_at = time.time()
+    # Удаляем пачкой, чтобы не держать долгую блокировку; остаток заберёт следующий вызов
+    cur = conn.cursor()
+    cur.execute(
+        """DELETE FROM tg_otp_sessions WHERE id IN (
+               SELECT id FROM tg_otp_sessions WHERE expires_at <= NOW()
+               LIMIT %s FOR UPDATE SKIP LOCKED
+           )""",
+        (OTP_PURGE_BATCH,)
+    )
+    deleted = cur.rowcount
+    cur.close()
+    if deleted:
+        print(f"[TG-SEND] Purged {deleted} expired OTP sessions")
+    return deleted
+
+def get_tg_loop():
+    global _tg_loop
+    with _tg_loop_lock:
+        if _tg_loop is None or _tg_loop.is_closed():
+            _tg_loop = asyncio.new_event_loop()
+            threading.Thread(target=_tg_loop.run_forever, daemon=True).start()
+    return _tg_loop
+
+def run_tg(coro):
+    # Все вызовы идут в общий loop, поэтому параллельные запросы делят одно соединение с Telegram
+    future = asyncio.run_coroutine_threadsafe(coro, get_tg_loop())
+    try:
+        return future.result(TG_CLIENT_TIMEOUT)
+    except FutureTimeoutError:
+        # Не оставляем зависший запрос работать в loop после ответа клиенту
+        future.cancel()
+        raise
+
+async def get_tg_client(provider_code: str, api_id: int, api_hash: str, session_str: str):
+    lock = _tg_client_locks.setdefault(provider_code, asyncio.Lock())
+    async with lock:
+        cached = _tg_clients.get(provider_code)
+        if cached and cached[:3] != (api_id, api_hash, session_str):
+            # Ключи или сессия провайдера поменялись (сессию пишут tg-send, tg-verify
+            # и API провайдеров) — клиент со старым auth key больше не годится
+            _tg_clients.pop(provider_code, None)
+            await cached[3].disconnect()
+            cached = None
+        if cached:
+            client = cached[3]
+        else:
+            client = TelegramClient(StringSession(session_str), api_id, api_hash)
+            _tg_clients[provider_code] = (api_id, api_hash, session_str, client)
+        if not client.is_connected():
+            await client.connect()
+        return client
+
+def remember_tg_session(provider_code: str, client, session_new: str) -> None:
+    # Эту сессию вызывающий сохранит в config провайдера — при следующем вызове клиент совпадёт с ней
+    cached = _tg_clients.get(provider_code)
+    if cached and cached[3] is client:
+        _tg_clients[provider_code] = cached[:2] + (session_new, client)
+
+async def send_code(provider_code: str, api_id: int, api_hash: str, session_str: str, phone: str):
+    client = await get_tg_client(provider_code, api_id, api_hash, session_str)
     result = await client.send_code_request(phone)
     session_new = client.session.save()
-    await client.disconnect()
+    remember_tg_session(provider_code, client, session_new)
     return result.phone_code_hash, session_new
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -54,74 +223,70 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {'statusCode': 401, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Missing API key'}), 'isBase64Encoded': False}
 
     conn = get_db_connection()
-    if not verify_api_key(api_key, conn):
-        conn.close()
-        return {'statusCode': 401, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Invalid API key'}), 'isBase64Encoded': False}
+    try:
+        if not verify_api_key(api_key, conn):
+            release_db_connection(conn)
+            return {'statusCode': 401, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Invalid API key'}), 'isBase64Encoded': False}
 
-    body = json.loads(event.get('body', '{}'))
-    provider_code = body.get('provider_code')
-    phone = body.get('phone')
+        body = json.loads(event.get('body', '{}'))
+        provider_code = body.get('provider_code')
+        phone = body.get('phone')
 
-    if not provider_code or not phone:
-        conn.close()
-        return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Missing provider_code or phone'}), 'isBase64Encoded': False}
+        if not provider_code or not phone:
+            release_db_connection(conn)
+            return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Missing provider_code or phone'}), 'isBase64Encoded': False}
 
-    tg_api_id, tg_api_hash, tg_session = get_tg_credentials(provider_code, conn)
-    if not tg_api_id or not tg_api_hash:
-        conn.close()
-        return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Telegram credentials not configured'}), 'isBase64Encoded': False}
+        tg_api_id, tg_api_hash, tg_session = get_tg_credentials(provider_code, conn)
+        if not tg_api_id or not tg_api_hash:
+            release_db_connection(conn)
+            return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Telegram credentials not configured'}), 'isBase64Encoded': False}
 
-    try:
-        phone_code_hash, session_new = asyncio.get_event_loop().run_until_complete(
-            send_code(int(str(tg_api_id).strip()), tg_api_hash.strip(), tg_session or '', phone)
+        try:
+            phone_code_hash, session_new = run_tg(
+                send_code(provider_code, int(str(tg_api_id).strip()), tg_api_hash.strip(), tg_session or '', phone)
+            )
+        except Exception as e:
+            release_db_connection(conn)
+            err = str(e)
+            print(f"[TG-SEND] Error: {err}")
+            # Маппим ошибки Telegram на понятные коды
+            error_map = {
+                'PHONE_NUMBER_INVALID': 'Неверный формат номера телефона',
+                'PHONE_NUMBER_BANNED': 'Этот номер телефона заблокирован в Telegram',
+                'API_ID_INVALID': 'Неверные API ID или API Hash провайдера',
+                'API_ID_PUBLISHED_FLOOD': 'API ID перегружен, попробуйте позже',
+                'FLOOD_WAIT': 'Слишком много запросов, попробуйте позже',
+            }
+            friendly = next((v for k, v in error_map.items() if k in err), err)
+            return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': friendly, 'error_raw': err}), 'isBase64Encoded': False}
+
+        import uuid as uuid_mod
+        # Сохраняем сессию обратно в конфиг провайдера (StringSession)
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE providers SET config = COALESCE(config, '{}'::jsonb) || %s::jsonb WHERE provider_code = %s",
+            (json.dumps({'tg_session': session_new}), provider_code)
         )
-    except Exception as e:
-        conn.close()
-        err = str(e)
-        print(f"[TG-SEND] Error: {err}")
-        # Маппим ошибки Telegram на понятные коды
-        error_map = {
-            'PHONE_NUMBER_INVALID': 'Неверный формат номера телефона',
-            'PHONE_NUMBER_BANNED': 'Этот номер телефона заблокирован в Telegram',
-            'API_ID_INVALID': 'Неверные API ID или API Hash провайдера',
-            'API_ID_PUBLISHED_FLOOD': 'API ID перегружен, попробуйте позже',
-            'FLOOD_WAIT': 'Слишком много запросов, попробуйте позже',
-        }
-        friendly = next((v for k, v in error_map.items() if k in err), err)
-        return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': friendly, 'error_raw': err}), 'isBase64Encoded': False}
 
-    import uuid as uuid_mod
-    # Сохраняем сессию обратно в конфиг провайдера (StringSession)
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE providers SET config = COALESCE(config, '{}'::jsonb) || %s::jsonb WHERE provider_code = %s",
-        (json.dumps({'tg_session': session_new}), provider_code)
-    )
+        save_otp_session(provider_code, phone, phone_code_hash, conn)
+        purge_expired_otp_sessions(conn)
+        # Пишем в лог сообщений как pending (ожидает верификации)
+        message_id = f"tgotp_{uuid_mod.uuid4().hex[:16]}"
+        cur.execute(
+            """INSERT INTO messages (message_id, provider, recipient, message_text, status, attempts, created_at)
+               VALUES (%s, %s, %s, %s, 'pending', 1, NOW())""",
+            (message_id, provider_code, phone, 'OTP code sent, awaiting verification')
+        )
+        conn.commit()
+        cur.close()
+        release_db_connection(conn)
 
-    # Удаляем старые сессии для этого номера и сохраняем новую
-    cur.execute(
-        "DELETE FROM tg_otp_sessions WHERE provider_code = %s AND phone = %s",
-        (provider_code, phone)
-    )
-    cur.execute(
-        "INSERT INTO tg_otp_sessions (provider_code, phone, phone_code_hash) VALUES (%s, %s, %s)",
-        (provider_code, phone, phone_code_hash)
-    )
-    # Пишем в лог сообщений как pending (ожидает верификации)
-    message_id = f"tgotp_{uuid_mod.uuid4().hex[:16]}"
-    cur.execute(
-        """INSERT INTO messages (message_id, provider, recipient, message_text, status, attempts, created_at)
-           VALUES (%s, %s, %s, %s, 'pending', 1, NOW())""",
-        (message_id, provider_code, phone, 'OTP code sent, awaiting verification')
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-
-    print(f"[TG-SEND] Code sent to {phone}, hash saved, logged as {message_id}")
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Code sent via Telegram'}),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+        print(f"[TG-SEND] Code sent to {phone}, hash saved, logged as {message_id}")
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'message': 'Code sent via Telegram'}),
+            'isBase64Encoded': False
+        }
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
@@ -1,22 +1,111 @@
 import json
 import os
+import time
 import asyncio
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, PhoneCodeExpiredError
 
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '30'))
+TG_CLIENT_TIMEOUT = int(os.environ.get('TG_CLIENT_TIMEOUT', '30'))
+
+# Пул соединений с БД, переживает warm-вызовы функции
+_db_pool = None
+# Выданные соединения и время возврата в пул: {id(conn): время}
+_db_checked_out: set = set()
+_db_released_at: Dict[int, float] = {}
+
+# Ключи, успешно прошедшие проверку: {api_key: время проверки}
+_api_key_cache: Dict[str, float] = {}
+
+# Фоновый event loop, в котором клиенты Telethon живут между warm-вызовами
+_tg_loop = None
+_tg_loop_lock = threading.Lock()
+# Подключённые клиенты по провайдерам: {provider_code: (api_id, api_hash, session_str, client)}
+_tg_clients: Dict[str, tuple] = {}
+_tg_client_locks: Dict[str, asyncio.Lock] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            os.environ['DATABASE_URL'],
+            cursor_factory=RealDictCursor
+        )
+    return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    
+    released_at = _db_released_at.get(id(conn))
+    if released_at and time.time() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+    pool = get_db_pool()
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            _db_checked_out.add(id(conn))
+            return conn
+        _db_released_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def release_db_connection(conn) -> None:
+    if conn is None or id(conn) not in _db_checked_out:
+        return
+    _db_checked_out.discard(id(conn))
+    
+    try:
+        if not conn.closed:
+            conn.rollback()
+        broken = bool(conn.closed)
+    except psycopg2.Error:
+        broken = True
+    
+    if broken:
+        _db_released_at.pop(id(conn), None)
+    else:
+        _db_released_at[id(conn)] = time.time()
+    get_db_pool().putconn(conn, close=broken)
 
 def verify_api_key(api_key: str, conn) -> bool:
+    checked_at = _api_key_cache.get(api_key)
+    if checked_at and time.time() - checked_at < API_KEY_CACHE_TTL:
+        return True
     cur = conn.cursor()
     cur.execute("SELECT id FROM api_keys WHERE api_key = %s AND is_active = true", (api_key,))
     result = cur.fetchone()
     cur.close()
-    return result is not None
+    if not result:
+        _api_key_cache.pop(api_key, None)
+        return False
+    _api_key_cache[api_key] = time.time()
+    return True
 
 def get_tg_credentials(provider_code: str, conn):
     cur = conn.cursor()
@@ -32,39 +121,76 @@ def get_otp_session(provider_code: str, phone: str, conn):
     cur = conn.cursor()
     cur.execute(
         """SELECT phone_code_hash FROM tg_otp_sessions
-           WHERE provider_code = %s AND phone = %s AND expires_at > NOW()
-           ORDER BY created_at DESC LIMIT 1""",
+           WHERE provider_code = %s AND phone = %s AND expires_at > NOW()""",
         (provider_code, phone)
     )
     result = cur.fetchone()
     cur.close()
     return result['phone_code_hash'] if result else None
 
-async def verify_code(api_id: int, api_hash: str, session_str: str, phone: str, code: str, phone_code_hash: str, password: str = None):
-    client = TelegramClient(StringSession(session_str), api_id, api_hash)
-    await client.connect()
+def get_tg_loop():
+    global _tg_loop
+    with _tg_loop_lock:
+        if _tg_loop is None or _tg_loop.is_closed():
+            _tg_loop = asyncio.new_event_loop()
+            threading.Thread(target=_tg_loop.run_forever, daemon=True).start()
+    return _tg_loop
+
+def run_tg(coro):
+    # Все вызовы идут в общий loop, поэтому параллельные запросы делят одно соединение с Telegram
+    future = asyncio.run_coroutine_threadsafe(coro, get_tg_loop())
+    try:
+        return future.result(TG_CLIENT_TIMEOUT)
+    except FutureTimeoutError:
+        # Не оставляем зависший запрос работать в loop после ответа клиенту
+        future.cancel()
+        raise
+
+async def get_tg_client(provider_code: str, api_id: int, api_hash: str, session_str: str):
+    lock = _tg_client_locks.setdefault(provider_code, asyncio.Lock())
+    async with lock:
+        cached = _tg_clients.get(provider_code)
+        if cached and cached[:3] != (api_id, api_hash, session_str):
+            # Ключи или сессия провайдера поменялись (сессию пишут tg-send, tg-verify
+            # и API провайдеров) — клиент со старым auth key больше не годится
+            _tg_clients.pop(provider_code, None)
+            await cached[3].disconnect()
+            cached = None
+        if cached:
+            client = cached[3]
+        else:
+            client = TelegramClient(StringSession(session_str), api_id, api_hash)
+            _tg_clients[provider_code] = (api_id, api_hash, session_str, client)
+        if not client.is_connected():
+            await client.connect()
+        return client
+
+def remember_tg_session(provider_code: str, client, session_new: str) -> None:
+    # Эту сессию вызывающий сохранит в config провайдера — при следующем вызове клиент совпадёт с ней
+    cached = _tg_clients.get(provider_code)
+    if cached and cached[3] is client:
+        _tg_clients[provider_code] = cached[:2] + (session_new, client)
+
+async def verify_code(provider_code: str, api_id: int, api_hash: str, session_str: str, phone: str, code: str, phone_code_hash: str, password: str = None):
+    client = await get_tg_client(provider_code, api_id, api_hash, session_str)
     try:
         await client.sign_in(phone=phone, code=code, phone_code_hash=phone_code_hash)
         session_new = client.session.save()
-        await client.disconnect()
+        remember_tg_session(provider_code, client, session_new)
         return True, None, session_new
     except PhoneCodeInvalidError:
-        await client.disconnect()
         return False, 'invalid_code', None
     except PhoneCodeExpiredError:
-        await client.disconnect()
         return False, 'expired_code', None
     except SessionPasswordNeededError:
         if not password:
-            await client.disconnect()
             return False, '2fa_required', None
         try:
             await client.sign_in(password=password)
             session_new = client.session.save()
-            await client.disconnect()
+            remember_tg_session(provider_code, client, session_new)
             return True, None, session_new
         except Exception:
-            await client.disconnect()
             return False, '2fa_invalid', None
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -86,77 +212,80 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {'statusCode': 401, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Missing API key'}), 'isBase64Encoded': False}
 
     conn = get_db_connection()
-    if not verify_api_key(api_key, conn):
-        conn.close()
-        return {'statusCode': 401, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Invalid API key'}), 'isBase64Encoded': False}
-
-    body = json.loads(event.get('body', '{}'))
-    provider_code = body.get('provider_code')
-    phone = body.get('phone')
-    code = body.get('code')
-    password = body.get('password')
-
-    if not provider_code or not phone or not code:
-        conn.close()
-        return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Missing provider_code, phone or code'}), 'isBase64Encoded': False}
-
-    phone_code_hash = get_otp_session(provider_code, phone, conn)
-    if not phone_code_hash:
-        conn.close()
-        return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Session not found or expired. Request a new code.'}), 'isBase64Encoded': False}
-
-    tg_api_id, tg_api_hash, tg_session = get_tg_credentials(provider_code, conn)
-    if not tg_api_id or not tg_api_hash:
-        conn.close()
-        return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Telegram credentials not configured'}), 'isBase64Encoded': False}
-
     try:
-        success, error_type, session_new = asyncio.get_event_loop().run_until_complete(
-            verify_code(int(str(tg_api_id).strip()), tg_api_hash.strip(), tg_session or '', phone, str(code), phone_code_hash, password)
-        )
-    except Exception as e:
-        conn.close()
-        print(f"[TG-VERIFY] Error: {e}")
-        return {'statusCode': 500, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': str(e)}), 'isBase64Encoded': False}
+        if not verify_api_key(api_key, conn):
+            release_db_connection(conn)
+            return {'statusCode': 401, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Invalid API key'}), 'isBase64Encoded': False}
 
-    if success:
-        import uuid
-        cur = conn.cursor()
-        # Сохраняем обновлённую сессию
-        if session_new:
+        body = json.loads(event.get('body', '{}'))
+        provider_code = body.get('provider_code')
+        phone = body.get('phone')
+        code = body.get('code')
+        password = body.get('password')
+
+        if not provider_code or not phone or not code:
+            release_db_connection(conn)
+            return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Missing provider_code, phone or code'}), 'isBase64Encoded': False}
+
+        phone_code_hash = get_otp_session(provider_code, phone, conn)
+        if not phone_code_hash:
+            release_db_connection(conn)
+            return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Session not found or expired. Request a new code.'}), 'isBase64Encoded': False}
+
+        tg_api_id, tg_api_hash, tg_session = get_tg_credentials(provider_code, conn)
+        if not tg_api_id or not tg_api_hash:
+            release_db_connection(conn)
+            return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'Telegram credentials not configured'}), 'isBase64Encoded': False}
+
+        try:
+            success, error_type, session_new = run_tg(
+                verify_code(provider_code, int(str(tg_api_id).strip()), tg_api_hash.strip(), tg_session or '', phone, str(code), phone_code_hash, password)
+            )
+        except Exception as e:
+            release_db_connection(conn)
+            print(f"[TG-VERIFY] Error: {e}")
+            return {'statusCode': 500, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': str(e)}), 'isBase64Encoded': False}
+
+        if success:
+            import uuid
+            cur = conn.cursor()
+            # Сохраняем обновлённую сессию
+            if session_new:
+                cur.execute(
+                    "UPDATE providers SET config = COALESCE(config, '{}'::jsonb) || %s::jsonb WHERE provider_code = %s",
+                    (json.dumps({'tg_session': session_new}), provider_code)
+                )
+            cur.execute("DELETE FROM tg_otp_sessions WHERE provider_code = %s AND phone = %s", (provider_code, phone))
+            # Пишем в лог сообщений как доставленное
+            message_id = f"tgotp_{uuid.uuid4().hex[:16]}"
             cur.execute(
-                "UPDATE providers SET config = COALESCE(config, '{}'::jsonb) || %s::jsonb WHERE provider_code = %s",
-                (json.dumps({'tg_session': session_new}), provider_code)
+                """INSERT INTO messages (message_id, provider, recipient, message_text, status, attempts, created_at, completed_at)
+                   VALUES (%s, %s, %s, %s, 'delivered', 1, NOW(), NOW())""",
+                (message_id, provider_code, phone, 'OTP code verified successfully')
             )
-        cur.execute("DELETE FROM tg_otp_sessions WHERE provider_code = %s AND phone = %s", (provider_code, phone))
-        # Пишем в лог сообщений как доставленное
-        message_id = f"tgotp_{uuid.uuid4().hex[:16]}"
-        cur.execute(
-            """INSERT INTO messages (message_id, provider, recipient, message_text, status, attempts, created_at, completed_at)
-               VALUES (%s, %s, %s, %s, 'delivered', 1, NOW(), NOW())""",
-            (message_id, provider_code, phone, 'OTP code verified successfully')
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        print(f"[TG-VERIFY] Code verified for {phone}, logged as {message_id}")
+            conn.commit()
+            cur.close()
+            release_db_connection(conn)
+            print(f"[TG-VERIFY] Code verified for {phone}, logged as {message_id}")
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, 'verified': True}),
+                'isBase64Encoded': False
+            }
+
+        release_db_connection(conn)
+        error_messages = {
+            'invalid_code': 'Неверный код',
+            'expired_code': 'Код истёк, запросите новый',
+            '2fa_required': 'Требуется пароль двухфакторной аутентификации',
+            '2fa_invalid': 'Неверный пароль двухфакторной аутентификации',
+        }
         return {
-            'statusCode': 200,
+            'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True, 'verified': True}),
+            'body': json.dumps({'success': False, 'error': error_messages.get(error_type, 'Ошибка верификации'), 'error_type': error_type}),
             'isBase64Encoded': False
         }
-
-    conn.close()
-    error_messages = {
-        'invalid_code': 'Неверный код',
-        'expired_code': 'Код истёк, запросите новый',
-        '2fa_required': 'Требуется пароль двухфакторной аутентификации',
-        '2fa_invalid': 'Неверный пароль двухфакторной аутентификации',
-    }
-    return {
-        'statusCode': 400,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': False, 'error': error_messages.get(error_type, 'Ошибка верификации'), 'error_type': error_type}),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
@@ -0,0 +1,4 @@
+-- Параметры доставки для сообщений, поставленных в очередь (async режим /send)
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS payload JSONB DEFAULT '{}';
+
+CREATE INDEX IF NOT EXISTS idx_messages_queued ON messages(created_at) WHERE status = 'queued';
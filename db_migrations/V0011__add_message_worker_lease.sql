@@ -0,0 +1,4 @@
+-- Аренда сообщения воркером доставки: после истечения сообщение возвращается в очередь
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_messages_processing_lease ON messages(locked_until) WHERE status = 'processing';
@@ -0,0 +1,4 @@
+-- Плановые повторы доставки: воркер забирает сообщения retrying, у которых наступил next_attempt_at
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_messages_retry_due ON messages(next_attempt_at) WHERE status = 'retrying';
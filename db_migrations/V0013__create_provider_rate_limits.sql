@@ -0,0 +1,6 @@
+-- Token bucket провайдеров: общий для всех процессов и экземпляров функций лимит отправок
+CREATE TABLE IF NOT EXISTS provider_rate_limits (
+    provider_code VARCHAR(50) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    refilled_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,9 @@
+-- Circuit breaker провайдеров: closed - отправки идут, open - отправки откладываются,
+-- half_open - одна пробная отправка решает, закрыть цепь или снова открыть
+CREATE TABLE IF NOT EXISTS provider_circuits (
+    provider_code VARCHAR(50) PRIMARY KEY,
+    state VARCHAR(10) NOT NULL DEFAULT 'closed',
+    failures INT NOT NULL DEFAULT 0,
+    opened_at TIMESTAMP,
+    probe_started_at TIMESTAMP
+);
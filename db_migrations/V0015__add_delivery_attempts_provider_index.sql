@@ -0,0 +1,3 @@
+-- Последние попытки по провайдеру: выборка задержек для адаптивных таймаутов
+CREATE INDEX IF NOT EXISTS idx_delivery_attempts_provider_attempted_at
+    ON delivery_attempts(provider, attempted_at DESC);
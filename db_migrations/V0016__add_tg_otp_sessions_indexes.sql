@@ -0,0 +1,11 @@
+-- Одна активная OTP-сессия на номер: оставляем только последнюю запись перед созданием уникального индекса
+DELETE FROM tg_otp_sessions t
+USING tg_otp_sessions newer
+WHERE t.provider_code = newer.provider_code
+  AND t.phone = newer.phone
+  AND t.id < newer.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tg_otp_sessions_provider_phone ON tg_otp_sessions(provider_code, phone);
+
+-- Фоновая очистка просроченных сессий
+CREATE INDEX IF NOT EXISTS idx_tg_otp_sessions_expires_at ON tg_otp_sessions(expires_at);
@@ -0,0 +1,5 @@
+-- Keyset-пагинация списка сообщений по (created_at, id) в обе стороны
+CREATE INDEX IF NOT EXISTS idx_messages_created_at_id ON messages(created_at DESC, id DESC);
+
+-- Покрывается idx_messages_created_at_id - лишний индекс только удорожает запись в messages
+DROP INDEX IF EXISTS idx_messages_created_at;
@@ -0,0 +1,16 @@
+-- Фильтры списка сообщений: равенство по ведущим колонкам и хвост (created_at, id) под keyset-пагинацию.
+-- Только диапазон created_at обслуживает idx_messages_created_at_id
+CREATE INDEX IF NOT EXISTS idx_messages_provider_status_created_at
+    ON messages(provider, status, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_messages_provider_created_at
+    ON messages(provider, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_messages_status_created_at
+    ON messages(status, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_messages_recipient_created_at
+    ON messages(recipient, created_at DESC, id DESC);
+
+-- Покрывается idx_messages_status_created_at
+DROP INDEX IF EXISTS idx_messages_status;
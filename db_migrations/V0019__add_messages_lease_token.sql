@@ -0,0 +1,4 @@
+-- Токен аренды: исход попытки записывает только тот, кто забрал сообщение.
+-- После истечения аренды и повторного захвата токен меняется, и запоздавший исполнитель
+-- не перезапишет чужое состояние
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS lease_token VARCHAR(32);